@@ -3,6 +3,7 @@
 """SVS mode decoding."""
 
 import argparse
+from distutils.version import LooseVersion
 import logging
 from pathlib import Path
 import shutil
@@ -27,6 +28,7 @@ from muskit.tasks.svs import SVSTask
 from muskit.torch_utils.device_funcs import to_device
 from muskit.torch_utils.set_all_random_seed import set_all_random_seed
 
+from muskit.svs.bytesing.decoder import Postnet
 from muskit.svs.naive_rnn.naive_rnn import NaiveRNN
 from muskit.svs.glu_transformer.glu_transformer import GLU_Transformer
 from muskit.svs.xiaoice.XiaoiceSing import XiaoiceSing
@@ -40,6 +42,15 @@ from muskit.utils.types import str2bool
 from muskit.utils.types import str2triple_str
 from muskit.utils.types import str_or_none
 
+is_torch_1_9_plus = LooseVersion(torch.__version__) >= LooseVersion("1.9.0")
+is_torch_1_10_plus = LooseVersion(torch.__version__) >= LooseVersion("1.10.0")
+
+if is_torch_1_9_plus:
+    # inference_mode also skips autograd version-counter / view tracking
+    inference_mode = torch.inference_mode
+else:
+    inference_mode = torch.no_grad
+
 
 class SingingGenerate:
     """SingingGenerate class
@@ -60,15 +71,24 @@ class SingingGenerate:
         dtype: str = "float32",
         device: str = "cpu",
         seed: int = 777,
+        use_amp: bool = False,
+        amp_dtype: str = "float16",
     ):
         assert check_argument_types()
+        if use_amp and not is_torch_1_10_plus:
+            raise RuntimeError("Require torch>=1.10.0 for Automatic Mixed Precision")
 
         model, train_args = SVSTask.build_model_from_file(
             train_config, model_file, device
         )
         model.to(dtype=getattr(torch, dtype)).eval()
+        for module in model.modules():
+            if isinstance(module, Postnet):
+                module.fuse_batch_norm()
         self.device = device
         self.dtype = dtype
+        self.use_amp = use_amp
+        self.amp_dtype = amp_dtype
         self.train_args = train_args
         self.model = model
         self.svs = model.svs
@@ -96,7 +116,7 @@ class SingingGenerate:
 
         self.decode_config = decode_config
 
-    @torch.no_grad()
+    @inference_mode()
     def __call__(
         self,
         text: torch.Tensor,
@@ -147,7 +167,18 @@ class SingingGenerate:
             cfg.update(decode_conf)
 
         batch = to_device(batch, self.device)
-        outs, outs_denorm, probs, att_ws = self.model.inference(**batch, **cfg)
+        if self.use_amp:
+            # weights stay in self.dtype; matmuls / convs run in amp_dtype
+            with torch.autocast(
+                device_type=torch.device(self.device).type,
+                dtype=getattr(torch, self.amp_dtype),
+            ):
+                outs, outs_denorm, probs, att_ws = self.model.inference(**batch, **cfg)
+            # hand full-precision features to the vocoder and the writers
+            outs = outs.to(getattr(torch, self.dtype))
+            outs_denorm = outs_denorm.to(getattr(torch, self.dtype))
+        else:
+            outs, outs_denorm, probs, att_ws = self.model.inference(**batch, **cfg)
 #         print(outs.shape)
 #         print(att_ws)
 #         if att_ws is not None:
@@ -216,6 +247,8 @@ def inference(
     allow_variable_data_keys: bool,
     vocoder_config: Optional[str] = None,
     vocoder_checkpoint: Optional[str] = None,
+    use_amp: bool = False,
+    amp_dtype: str = "float16",
 ):
     """Perform SVS model decoding."""
     assert check_argument_types()
@@ -245,6 +278,8 @@ def inference(
         vocoder_checkpoint=vocoder_checkpoint,
         dtype=dtype,
         device=device,
+        use_amp=use_amp,
+        amp_dtype=amp_dtype,
     )
 
     # 3. Build data-iterator
@@ -441,9 +476,21 @@ def get_parser():
     parser.add_argument(
         "--dtype",
         default="float32",
-        choices=["float16", "float32", "float64"],
+        choices=["float16", "bfloat16", "float32", "float64"],
         help="Data type",
     )
+    parser.add_argument(
+        "--use_amp",
+        type=str2bool,
+        default=False,
+        help="Run the model under torch.autocast (weights stay in --dtype)",
+    )
+    parser.add_argument(
+        "--amp_dtype",
+        default="float16",
+        choices=["float16", "bfloat16"],
+        help="Compute dtype for --use_amp",
+    )
     parser.add_argument(
         "--num_workers",
         type=int,
@@ -129,6 +129,34 @@ class Prenet(torch.nn.Module):
         return x
 
 
+def _fuse_conv_batch_norm(conv, bn):
+    """Return a Conv1d equal to ``bn(conv(x))`` with frozen ``bn`` statistics."""
+    with torch.no_grad():
+        scale = bn.running_var.float().add(bn.eps).rsqrt()
+        if bn.affine:
+            scale = scale * bn.weight.float()
+        bias = -bn.running_mean.float()
+        if conv.bias is not None:
+            bias = bias + conv.bias.float()
+        bias = bias * scale
+        if bn.affine:
+            bias = bias + bn.bias.float()
+
+        fused = torch.nn.Conv1d(
+            conv.in_channels,
+            conv.out_channels,
+            conv.kernel_size,
+            stride=conv.stride,
+            padding=conv.padding,
+            dilation=conv.dilation,
+            groups=conv.groups,
+            bias=True,
+        ).to(device=conv.weight.device, dtype=conv.weight.dtype)
+        fused.weight.copy_(conv.weight.float() * scale[:, None, None])
+        fused.bias.copy_(bias)
+    return fused
+
+
 class Postnet(torch.nn.Module):
     """Postnet module for Spectrogram prediction network.
     This is a module of Postnet in Spectrogram prediction network,
@@ -239,6 +267,21 @@ class Postnet(torch.nn.Module):
             xs = self.postnet[i](xs)
         return xs
 
+    def fuse_batch_norm(self):
+        """Fold each BatchNorm1d into its preceding Conv1d for inference.
+        The running statistics become a per-channel affine of the convolution,
+        so the folded layers drop the extra read / write of BatchNorm.
+        This changes the parameter names in ``state_dict()``,
+        so call it only on a model that will not be trained or saved again.
+        """
+        assert not self.training, "BatchNorm can only be folded in eval mode."
+        for i in six.moves.range(len(self.postnet)):
+            layers = list(self.postnet[i])
+            if len(layers) < 2 or not isinstance(layers[1], torch.nn.BatchNorm1d):
+                continue
+            fused = _fuse_conv_batch_norm(layers[0], layers[1])
+            self.postnet[i] = torch.nn.Sequential(fused, *layers[2:])
+
 
 class Decoder(torch.nn.Module):
     """Decoder module of Spectrogram prediction network.
@@ -5,6 +5,7 @@
 
 import logging
 
+from distutils.version import LooseVersion
 from typing import Dict
 from typing import Optional
 from typing import Sequence
@@ -13,7 +14,6 @@ from typing import Tuple
 import numpy as np
 import torch
 import torch as t
-from torch.autograd import Variable
 import math
 import copy
 import torch.nn.functional as F
@@ -21,7 +21,7 @@ import torch.nn.functional as F
 
 from typeguard import check_argument_types
 
-from muskit.torch_utils.nets_utils import make_pad_mask, make_non_pad_mask
+from muskit.torch_utils.nets_utils import make_non_pad_mask
 from muskit.torch_utils.initialize import initialize
 from muskit.layers.glu import GLU
 from muskit.layers.transformer.attention import MultiHeadedAttention
@@ -38,15 +38,7 @@ from muskit.svs.gst.style_encoder import StyleEncoder
 
 SCALE_WEIGHT = 0.5**0.5
 
-
-def _get_activation_fn(activation):
-    """_get_activation_fn."""
-    if activation == "relu":
-        return F.relu
-    elif activation == "gelu":
-        return F.gelu
-    else:
-        raise RuntimeError("activation should be relu/gelu, not %s." % activation)
+is_torch_2_0_plus = LooseVersion(torch.__version__) >= LooseVersion("2.0.0")
 
 
 def _get_clones(module, N):
@@ -90,6 +82,18 @@ class PostNet(torch.nn.Module):
         return output
 
 
+class LinearLeakyReLU(torch.nn.Linear):
+    """Linear layer followed by an in-place leaky ReLU.
+
+    Keeps the parameter names of torch.nn.Linear, so it is a drop-in
+    replacement for checkpoints saved with a plain Linear.
+    """
+
+    def forward(self, x):
+        """forward."""
+        return F.leaky_relu(F.linear(x, self.weight, self.bias), inplace=True)
+
+
 class Encoder_Postnet(torch.nn.Module):
     """Encoder Postnet."""
 
@@ -103,28 +107,27 @@ class Encoder_Postnet(torch.nn.Module):
         # text_phone = [batch_size, text_phone_length]
         # align_phone_length( = frame_num) > text_phone_length
         batch = encoder_out.size()[0]
-        align_phone_length = align_phone.size()[1]
         emb_dim = encoder_out.size()[2]
+        text_phone_length = text_phone.size()[1]
         align_phone = align_phone.long()
-        text_phone = text_phone.long()
-        out = torch.zeros(
-            (batch, align_phone_length, emb_dim),
-            dtype=torch.float,
-            device=encoder_out.device,
+
+        # every phone change in the alignment moves on to the next encoder frame
+        phone_change = (align_phone[:, 1:] != align_phone[:, :-1]).long()
+        enc_idx = torch.cat(
+            [
+                torch.zeros((batch, 1), dtype=torch.long, device=align_phone.device),
+                phone_change.cumsum(dim=1),
+            ],
+            dim=1,
         )
-        for i in range(batch):
-            before_text_phone = text_phone[i][0]
-            encoder_ind = 0
-            out[i, 0, :] = encoder_out[i][0]
-            for j in range(1, align_phone_length):
-                if align_phone[i][j] == before_text_phone:
-                    out[i, j, :] = encoder_out[i][encoder_ind]
-                else:
-                    encoder_ind += 1
-                    if encoder_ind >= text_phone[i].size()[0]:
-                        break
-                    before_text_phone = text_phone[i][encoder_ind]
-                    out[i, j, :] = encoder_out[i][encoder_ind]
+        # frames after the last text phone stay zero
+        valid = enc_idx < text_phone_length
+        enc_idx = enc_idx.clamp_max(text_phone_length - 1)
+
+        out = torch.gather(
+            encoder_out, 1, enc_idx.unsqueeze(-1).expand(-1, -1, emb_dim)
+        )
+        out = out.masked_fill(~valid.unsqueeze(-1), 0.0)
 
         return out
 
@@ -159,11 +162,11 @@ class Attention(torch.nn.Module):
 
         self.local_gaussian = local_gaussian
         if local_gaussian:
-            self.local_gaussian_factor = Variable(
-                t.tensor(30.0), requires_grad=True
-            ).float()
+            self.local_gaussian_factor = torch.nn.Parameter(torch.tensor(30.0))
         else:
             self.local_gaussian_factor = None
+        # squared distance between positions, extended on demand
+        self.sq_dist = None
 
         self.residual_dropout = torch.nn.Dropout(p=dropout_rate)
 
@@ -171,67 +174,41 @@ class Attention(torch.nn.Module):
 
         self.layer_norm_1 = torch.nn.LayerNorm(num_hidden)
 
-    def forward(self, memory, decoder_input, mask=None, query_mask=None):
+        self._register_load_state_dict_pre_hook(self._load_state_dict_pre_hook)
+
+    def forward(self, memory, decoder_input, mask=None):
         """forward."""
         batch_size = memory.size(0)
         seq_k = memory.size(1)
         seq_q = decoder_input.size(1)
 
-        # Repeat masks h times
-        if query_mask is not None:
-            query_mask = query_mask.unsqueeze(-1).repeat(1, 1, seq_k)
-            query_mask = query_mask.repeat(self.h, 1, 1)
-        if mask is not None:
-            mask = mask.repeat(self.h, 1, 1)
+        if memory is decoder_input:
+            # self-attention: a single GEMM over the stacked projection weights
+            weight = torch.cat(
+                [self.key.weight, self.value.weight, self.query.weight], dim=0
+            )
+            key, value, query = F.linear(memory, weight).chunk(3, dim=-1)
+        else:
+            key = self.key(memory)
+            value = self.value(memory)
+            query = self.query(decoder_input)
 
-        # Make multihead
-        key = self.key(memory).view(batch_size, seq_k, self.h, self.num_hidden_per_attn)
-        value = self.value(memory).view(
-            batch_size, seq_k, self.h, self.num_hidden_per_attn
-        )
-        query = self.query(decoder_input).view(
-            batch_size, seq_q, self.h, self.num_hidden_per_attn
-        )
-
-        key = (
-            key.permute(2, 0, 1, 3)
-            .contiguous()
-            .view(-1, seq_k, self.num_hidden_per_attn)
-        )
-        value = (
-            value.permute(2, 0, 1, 3)
-            .contiguous()
-            .view(-1, seq_k, self.num_hidden_per_attn)
-        )
-        query = (
-            query.permute(2, 0, 1, 3)
-            .contiguous()
-            .view(-1, seq_q, self.num_hidden_per_attn)
-        )
+        # Make multihead: (batch, time, head, num_hidden_per_attn)
+        key = key.view(batch_size, seq_k, self.h, self.num_hidden_per_attn)
+        value = value.view(batch_size, seq_k, self.h, self.num_hidden_per_attn)
+        query = query.view(batch_size, seq_q, self.h, self.num_hidden_per_attn)
 
         # add gaussian or not
         if self.local_gaussian:
-            row = (
-                t.arange(1, seq_k + 1)
-                .unsqueeze(0)
-                .unsqueeze(-1)
-                .repeat(batch_size * self.h, 1, seq_k)
-            )
-            col = (
-                t.arange(1, seq_k + 1)
-                .unsqueeze(0)
-                .unsqueeze(0)
-                .repeat(batch_size * self.h, seq_k, 1)
-            )
-            local_gaussian = t.pow(row - col, 2).float().to(key.device.type)
-            self.local_gaussian_factor = self.local_gaussian_factor.to(key.device.type)
+            self.extend_sq_dist(seq_k, key.device)
+            # (1, seq_k, seq_k), broadcast over batch and heads
+            local_gaussian = self.sq_dist[:seq_k, :seq_k].unsqueeze(0)
             local_gaussian = local_gaussian / self.local_gaussian_factor
         else:
             local_gaussian = None
 
         # Get context vector
-        # result, attns = self.multihead(
-        result = self.multihead(
+        result = self._multihead_attention(
             key,
             value,
             query,
@@ -239,18 +216,15 @@ class Attention(torch.nn.Module):
             gaussian_factor=local_gaussian,
         )
 
-        # attns = attns.view(self.h, batch_size, seq_q, seq_k)
-        # attns = attns.permute(1, 0, 2, 3)
-
         # Concatenate all multihead context vector
-        result = result.view(self.h, batch_size, seq_q, self.num_hidden_per_attn)
-        result = result.permute(1, 2, 0, 3).contiguous().view(batch_size, seq_q, -1)
-
-        # Concatenate context vector with input (most important)
-        result = t.cat([decoder_input, result], dim=-1)
+        result = result.view(batch_size, seq_q, -1)
 
-        # Final linear
-        result = self.final_linear(result)
+        # Final linear over [decoder_input; context] (most important), computed
+        # on the two weight halves so the 2x-wide concat is never materialized
+        weight = self.final_linear.weight
+        result = F.linear(
+            result, weight[:, self.num_hidden :], self.final_linear.bias
+        ) + F.linear(decoder_input, weight[:, : self.num_hidden])
 
         # Residual dropout & connection
         result = result + decoder_input
@@ -262,6 +236,134 @@ class Attention(torch.nn.Module):
 
         return result  # , attns
 
+    def _load_state_dict_pre_hook(
+        self,
+        state_dict,
+        prefix,
+        local_metadata,
+        strict,
+        missing_keys,
+        unexpected_keys,
+        error_msgs,
+    ):
+        """Apply pre hook function before loading state dict.
+        `local_gaussian_factor` is registered as a parameter now, but old models
+        kept it as a plain tensor and do not include it. This function adds the
+        initial value to the state dict so that old models can still be loaded.
+        """
+        key = prefix + "local_gaussian_factor"
+        if self.local_gaussian and key not in state_dict:
+            state_dict[key] = torch.tensor(30.0)
+
+    def extend_sq_dist(self, seq_len, device):
+        """Reset the squared position distances of the local gaussian."""
+        if self.sq_dist is not None and self.sq_dist.size(0) >= seq_len:
+            if self.sq_dist.device != device:
+                self.sq_dist = self.sq_dist.to(device=device)
+            return
+        position = t.arange(seq_len, dtype=torch.float32, device=device)
+        self.sq_dist = t.pow(position.unsqueeze(1) - position.unsqueeze(0), 2)
+
+    def _multihead_attention(self, query, key, value, mask=None, gaussian_factor=None):
+        """Apply self.multihead to every head of (batch, time, head, d) inputs.
+
+        Same math as calling self.multihead with the heads folded into the batch
+        axis, but the heads stay a separate axis so no permuted copies are made.
+        On PyTorch>=2.0 F.scaled_dot_product_attention is used, which can pick a
+        fused (flash / memory-efficient) kernel; self.multihead.attn is not set.
+
+        Args:
+            query (Tensor): Query tensor (#batch, time1, head, d).
+            key (Tensor): Key tensor (#batch, time2, head, d).
+            value (Tensor): Value tensor (#batch, time2, head, d).
+            mask (Tensor): Mask tensor (#batch, time1, time2) or (#batch, 1, time2).
+            gaussian_factor (Tensor): Gaussian bias (1, time1, time2).
+
+        Returns:
+            Tensor: Output tensor (#batch, time1, head, d).
+
+        """
+        mha = self.multihead
+        n_batch, n_head = query.size(0), query.size(2)
+
+        def _split_heads(x, linear):
+            # (batch, time, head, d) -> (batch, head * inner_head, time, d_k)
+            x = linear(x).view(x.size(0), x.size(1), n_head * mha.h, mha.d_k)
+            return x.transpose(1, 2)
+
+        q = _split_heads(query, mha.linear_q)
+        k = _split_heads(key, mha.linear_k)
+        v = _split_heads(value, mha.linear_v)
+
+        if mask is not None:
+            mask = mask.unsqueeze(1).eq(0)  # (batch, 1, *, time2)
+        if gaussian_factor is not None:
+            gaussian_factor = gaussian_factor.unsqueeze(1).to(dtype=q.dtype)
+
+        if is_torch_2_0_plus:
+            attn_mask = None
+            if gaussian_factor is not None:
+                attn_mask = -gaussian_factor
+            if mask is not None:
+                if attn_mask is None:
+                    attn_mask = ~mask
+                else:
+                    attn_mask = torch.where(mask, torch.finfo(q.dtype).min, attn_mask)
+            x = F.scaled_dot_product_attention(
+                q,
+                k,
+                v,
+                attn_mask=attn_mask,
+                dropout_p=mha.dropout.p if self.training else 0.0,
+            )
+        else:
+            scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(mha.d_k)
+            if gaussian_factor is not None:
+                scores = scores - gaussian_factor
+            if mask is not None:
+                scores = scores.masked_fill(mask, torch.finfo(scores.dtype).min)
+                attn = torch.softmax(scores, dim=-1).masked_fill(mask, 0.0)
+            else:
+                attn = torch.softmax(scores, dim=-1)
+            x = torch.matmul(mha.dropout(attn), v)
+
+        # (batch, head * inner_head, time1, d_k) -> (batch, time1, head, d)
+        x = x.transpose(1, 2).reshape(n_batch, -1, n_head, mha.h * mha.d_k)
+        return mha.linear_out(x)
+
+
+@torch.jit.script
+def _dropout_residual_scale(
+    x: torch.Tensor, y: torch.Tensor, p: float, training: bool, scale: float
+) -> torch.Tensor:
+    """Compute (x + dropout(y)) * scale as one scripted (fusible) pointwise op."""
+    # scale the fresh sum in place; eager (unfused) runs then allocate only once
+    return (x + F.dropout(y, p, training)).mul_(scale)
+
+
+@torch.jit.script
+def _residual_scale(x: torch.Tensor, y: torch.Tensor, scale: float) -> torch.Tensor:
+    """Compute (x + y) * scale as one scripted (fusible) pointwise op."""
+    return (x + y) * scale
+
+
+@torch.jit.script
+def _add_utterance_embeddings(
+    hs: torch.Tensor,
+    sid_embs: Optional[torch.Tensor],
+    lid_embs: Optional[torch.Tensor],
+    spk_embs: Optional[torch.Tensor],
+) -> torch.Tensor:
+    """Add the given (B, D) utterance embeddings to every frame of hs (B, T, D)."""
+    utt_embs: Optional[torch.Tensor] = sid_embs
+    if lid_embs is not None:
+        utt_embs = lid_embs if utt_embs is None else utt_embs + lid_embs
+    if spk_embs is not None:
+        utt_embs = spk_embs if utt_embs is None else utt_embs + spk_embs
+    if utt_embs is None:
+        return hs
+    return hs.add_(utt_embs.unsqueeze(1))
+
 
 class TransformerGLULayer(torch.nn.Module):
     """TransformerGLULayer."""
@@ -271,7 +373,6 @@ class TransformerGLULayer(torch.nn.Module):
         d_model,
         nhead,
         dropout=0.1,
-        activation="relu",
         glu_kernel=3,
         local_gaussian=False,
     ):
@@ -288,26 +389,24 @@ class TransformerGLULayer(torch.nn.Module):
         self.norm2 = torch.nn.LayerNorm(d_model)
         self.dropout1 = torch.nn.Dropout(dropout)
         self.dropout2 = torch.nn.Dropout(dropout)
-        self.activation = _get_activation_fn(activation)
-
-    def __setstate__(self, state):
-        """__setstate__."""
-        if "activation" not in state:
-            state["activation"] = F.relu
-        super(TransformerGLULayer, self).__setstate__(state)
 
-    def forward(self, src, mask=None, query_mask=None):
+    def forward(
+        self,
+        src: torch.Tensor,
+        mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
         """forward."""
         src1 = self.norm1(src)
-        # src2, att_weight = self.self_attn(src1, src1, mask=mask, query_mask=query_mask)
-        src2 = self.self_attn(src1, src1, mask=mask, query_mask=query_mask)
-        src3 = src + self.dropout1(src2)
-        src3 = src3 * SCALE_WEIGHT
+        src2 = self.self_attn(src1, src1, mask=mask)
+        src3 = _dropout_residual_scale(
+            src, src2, self.dropout1.p, self.training, SCALE_WEIGHT
+        )
         src4 = self.norm2(src3)
         src5 = self.GLU(src4)
         src5 = src5.transpose(1, 2)
-        src6 = src3 + self.dropout2(src5)
-        src6 = src6 * SCALE_WEIGHT
+        src6 = _dropout_residual_scale(
+            src3, src5, self.dropout2.p, self.training, SCALE_WEIGHT
+        )
         return src6
 
 
@@ -364,9 +463,7 @@ class GLUEncoder(torch.nn.Module):
 
         glu_out = self.fc_2(glu_in)
 
-        out = embedded_phone + glu_out
-
-        out = out * math.sqrt(0.5)
+        out = _residual_scale(embedded_phone, glu_out, math.sqrt(0.5))
         return out, text_phone
 
 
@@ -381,7 +478,7 @@ class TransformerEncoder(torch.nn.Module):
 
     __constants__ = ["norm"]
 
-    def __init__(self, encoder_layer, num_layers, norm=None):
+    def __init__(self, encoder_layer, num_layers, norm=None, use_torch_compile=False):
         """init."""
         super(TransformerEncoder, self).__init__()
         assert num_layers > 0
@@ -389,7 +486,33 @@ class TransformerEncoder(torch.nn.Module):
         self.num_layers = num_layers
         self.norm = norm
 
-    def forward(self, src, mask=None, query_mask=None):
+        self.use_torch_compile = use_torch_compile
+        if use_torch_compile:
+            if not is_torch_2_0_plus:
+                raise RuntimeError("Require torch>=2.0.0 for use_torch_compile")
+            # trace the whole layer stack into a single graph
+            self._forward_layers = torch.compile(self._forward_layers, dynamic=True)
+
+    def _forward_layers(
+        self,
+        src: torch.Tensor,
+        mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        output = src
+
+        for mod in self.layers:
+            output = mod(output, mask=mask)
+
+        if self.norm is not None:
+            output = self.norm(output)
+
+        return output
+
+    def forward(
+        self,
+        src: torch.Tensor,
+        mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
         """Pass the input through the encoder layers in turn.
         Args:
             src: the sequence to the encoder (required).
@@ -399,18 +522,7 @@ class TransformerEncoder(torch.nn.Module):
         Shape:
             see the docs in Transformer class.
         """
-        # #type: (Tensor, Optional[Tensor], Optional[Tensor]) -> Tensor
-
-        output = src
-
-        for mod in self.layers:
-            # output, att_weight = mod(output, mask=mask, query_mask=query_mask)
-            output = mod(output, mask=mask, query_mask=query_mask)
-
-        if self.norm is not None:
-            output = self.norm(output)
-
-        return output  # , att_weight
+        return self._forward_layers(src, mask=mask)
 
 
 class GLUDecoder(torch.nn.Module):
@@ -423,9 +535,9 @@ class GLUDecoder(torch.nn.Module):
         output_dim,
         nhead=4,
         dropout=0.1,
-        activation="relu",
         glu_kernel=3,
         local_gaussian=False,
+        use_torch_compile=False,
     ):
         """init."""
         super(GLUDecoder, self).__init__()
@@ -434,28 +546,29 @@ class GLUDecoder(torch.nn.Module):
             hidden_size,
             nhead,
             dropout,
-            activation,
             glu_kernel,
             local_gaussian=local_gaussian,
         )
-        self.decoder = TransformerEncoder(decoder_layer, num_block)
+        self.decoder = TransformerEncoder(
+            decoder_layer, num_block, use_torch_compile=use_torch_compile
+        )
         self.output_fc = torch.nn.Linear(hidden_size, output_dim)
 
         self.hidden_size = hidden_size
 
-    def forward(self, src, pos):  # pos: pad = False mask
-        """forward."""
-        if self.training:
-            query_mask = pos.ne(0).type(torch.float)
-        else:
-            query_mask = None
-        mask = pos.unsqueeze(1).repeat(1, src.size(1), 1)  # pad=Fasle mask
+    def forward_hidden(self, src, pos):  # pos: pad = False mask
+        """Run the decoder blocks without the final output_fc."""
+        # (batch, 1, time), broadcast over query frames in the attention
+        mask = pos.unsqueeze(1)  # pad=Fasle mask
 
         src = self.input_norm(src)
-        # memory, att_weight = self.decoder(src, mask=mask, query_mask=query_mask)
-        memory = self.decoder(src, mask=mask, query_mask=query_mask)
+        return self.decoder(src, mask=mask)
+
+    def forward(self, src, pos):  # pos: pad = False mask
+        """forward."""
+        memory = self.forward_hidden(src, pos)
         output = self.output_fc(memory)
-        return output  # , att_weight
+        return output
 
 
 # /muskit/layers/transformer
@@ -502,6 +615,8 @@ class GLU_Transformer(AbsSVS):
         use_masking: bool = False,
         use_weighted_masking: bool = False,
         loss_type: str = "L1",
+        use_torch_compile: bool = False,  # torch.compile decoder stack (torch>=2.0)
+        use_raw_pe: bool = False,  # feed only the sinusoid table to fc_pos
     ):
         """init."""
         assert check_argument_types()
@@ -516,6 +631,7 @@ class GLU_Transformer(AbsSVS):
         self.embed_integration_type = embed_integration_type
         self.reduction_factor = reduction_factor
         self.loss_type = loss_type
+        self.use_raw_pe = use_raw_pe
 
         # use idx 0 as padding idx
         self.padding_idx = 0
@@ -550,8 +666,8 @@ class GLU_Transformer(AbsSVS):
         # define length regulator
         self.length_regulator = LengthRegulator()
 
-        self.fc_midi = torch.nn.Linear(embed_dim, embed_dim)
-        self.fc_pos = torch.nn.Linear(embed_dim, embed_dim)
+        self.fc_midi = LinearLeakyReLU(embed_dim, embed_dim)
+        self.fc_pos = LinearLeakyReLU(embed_dim, embed_dim)
 
         self.decoder = GLUDecoder(
             num_block=dlayers,
@@ -561,12 +677,11 @@ class GLU_Transformer(AbsSVS):
             dropout=ddropout_rate,
             glu_kernel=glu_kernel,
             local_gaussian=local_gaussian,
+            use_torch_compile=use_torch_compile,
         )
 
         # define final projection
-        self.feat_out = torch.nn.Linear(
-            odim // reduction_factor, odim * reduction_factor
-        )
+        self.feat_out = torch.nn.Linear(odim, odim * reduction_factor)
 
         # define postnet
         self.postnet = (
@@ -611,10 +726,41 @@ class GLU_Transformer(AbsSVS):
             self.spk_embed_dim = spk_embed_dim
             self.spk_embed_integration_type = spk_embed_integration_type
         if self.spk_embed_dim is not None:
+            # NOTE: kept apart from self.projection (label / midi integration)
             if self.spk_embed_integration_type == "add":
-                self.projection = torch.nn.Linear(self.spk_embed_dim, eunits)
+                self.spk_projection = torch.nn.Linear(self.spk_embed_dim, eunits)
             else:
-                self.projection = torch.nn.Linear(eunits + self.spk_embed_dim, eunits)
+                self.spk_projection = torch.nn.Linear(
+                    eunits + self.spk_embed_dim, eunits
+                )
+
+        self._register_load_state_dict_pre_hook(self._load_state_dict_pre_hook)
+
+    def _load_state_dict_pre_hook(
+        self,
+        state_dict,
+        prefix,
+        local_metadata,
+        strict,
+        missing_keys,
+        unexpected_keys,
+        error_msgs,
+    ):
+        """Apply pre hook function before loading state dict.
+        Old models stored the speaker embedding projection as `projection`,
+        replacing the label / midi integration layer of the same name. This
+        function moves it to `spk_projection` and fills `projection` with its
+        current (untrained) value so that old models can still be loaded.
+        """
+        if self.spk_embed_dim is None:
+            return
+        if prefix + "spk_projection.weight" in state_dict:
+            return
+        for name, param in self.projection.named_parameters():
+            old_key = prefix + "projection." + name
+            if old_key in state_dict:
+                state_dict[prefix + "spk_projection." + name] = state_dict[old_key]
+                state_dict[old_key] = param.detach().clone()
 
     def _reset_parameters(self, init_type):
         # initialize parameters
@@ -668,75 +814,16 @@ class GLU_Transformer(AbsSVS):
         # tempo = label[:, : tempo_lengths.max()]  # for data-parallel
         batch_size = text.size(0)
 
-        phone_emb, _ = self.phone_encoder(text)
-        midi_emb = self.midi_encoder_input_layer(midi)
-
-        label_emb = self.length_regulator(phone_emb, ds)
-        # label_emb = self.enc_postnet(
-        #     phone_emb, label, text
-        # )
-
-        midi_emb = F.leaky_relu(self.fc_midi(midi_emb))
-
-        if self.embed_integration_type == "add":
-            hs = label_emb + midi_emb
-        else:
-            hs = torch.cat((label_emb, midi_emb), dim=-1)
-
-        # hs = F.leaky_relu(self.projection(hs))
-
-        # integrate spk & lang embeddings
-        if self.spks is not None:
-            sid_embs = self.sid_emb(sids.view(-1))
-            hs = hs + sid_embs.unsqueeze(1)
-        if self.langs is not None:
-            lid_embs = self.lid_emb(lids.view(-1))
-            hs = hs + lid_embs.unsqueeze(1)
-
-        # integrate speaker embedding
-        if self.spk_embed_dim is not None:
-            hs = self._integrate_with_spk_embed(hs, spembs)
-
-        pos_emb = self.pos(hs)
-        pos_out = F.leaky_relu(self.fc_pos(pos_emb))
-
-        hs = hs + pos_out
-
-        # logging.info(f'Tao - hs:{hs.shape}')
-        # decoder
-        # mel_output, att_weight = self.decoder(
-        zs = self.decoder(
-            hs, pos=(~make_pad_mask(midi_lengths)).to(device=hs.device)
-        )  # True mask
-        # mel_output2 = self.double_mel(mel_output)
-
-        zs = zs[:, self.reduction_factor - 1 :: self.reduction_factor]
-
-        before_outs = F.leaky_relu(self.feat_out(zs).view(zs.size(0), -1, self.odim))
-
-        # logging.info(f'mel_output:{mel_output}')
-        # zs = self.postnet(zs.transpose(1, 2))
-        # zs = zs.transpose(1, 2)
-
-        # (B, T_feats//r, odim * r) -> (B, T_feats//r * r, odim)
-
-        # postnet -> (B, T_feats//r * r, odim)
-        if self.postnet is None:
-            after_outs = before_outs
-        else:
-            after_outs = before_outs + self.postnet(
-                before_outs.transpose(1, 2)
-            ).transpose(1, 2)
+        hs = self.encode(text, midi, ds, spembs=spembs, sids=sids, lids=lids)
+        before_outs, after_outs = self.decode(hs, midi_lengths)
 
         # modifiy mod part of groundtruth
         if self.reduction_factor > 1:
             assert feats_lengths.ge(
                 self.reduction_factor
             ).all(), "Output length must be greater than or equal to reduction factor."
-            olens = feats_lengths.new(
-                [olen - olen % self.reduction_factor for olen in feats_lengths]
-            )
-            max_olen = max(olens)
+            olens = feats_lengths - feats_lengths % self.reduction_factor
+            max_olen = int(olens.max())
             ys = feats[:, :max_olen]
         else:
             ys = feats
@@ -792,120 +879,167 @@ class GLU_Transformer(AbsSVS):
 
     #     return output, att_weight, mel_output, mel_output2
 
-    def inference(
+    def encode(
         self,
         text: torch.Tensor,
-        label: torch.Tensor,
         midi: torch.Tensor,
-        feats: torch.Tensor = None,
+        ds: torch.Tensor,
         spembs: Optional[torch.Tensor] = None,
         sids: Optional[torch.Tensor] = None,
         lids: Optional[torch.Tensor] = None,
-    ) -> Tuple[torch.Tensor, Dict[str, torch.Tensor], torch.Tensor]:
-        """Calculate forward propagation.
+    ) -> torch.Tensor:
+        """Encode phones and notes into frame-level hidden states.
         Args:
-            text (LongTensor): Batch of padded character ids (Tmax).
-            label (Tensor)
-            midi (Tensor)
-            feats (Tensor): Batch of padded target features (Lmax, odim).
-            spembs (Optional[Tensor]): Batch of speaker embeddings (spk_embed_dim).
-            sids (Optional[Tensor]): Batch of speaker IDs (1).
-            lids (Optional[Tensor]): Batch of language IDs (1).
+            text (LongTensor): Batch of padded phone ids (B, Tmax).
+            midi (LongTensor): Batch of padded frame-level midi ids (B, Lmax).
+            ds (LongTensor): Batch of phone durations (B, Tmax).
+            spembs (Optional[Tensor]): Batch of speaker embeddings (B, spk_embed_dim).
+            sids (Optional[Tensor]): Batch of speaker IDs (B, 1).
+            lids (Optional[Tensor]): Batch of language IDs (B, 1).
 
         Returns:
-            Dict[str, Tensor]: Output dict including the following items:
-                * feat_gen (Tensor): Output sequence of features (T_feats, odim).
+            Tensor: Batch of frame-level hidden states (B, Lmax, embed_dim).
         """
-        text = text.unsqueeze(0)  # for data-parallel
-        feats = feats.unsqueeze(0)  # for data-parallel
-        midi = midi.unsqueeze(0)  # for data-parallel
-        label = label.unsqueeze(0)  # for data-parallel
-
-        label_emb = self.encoder_input_layer(label)
+        phone_emb, _ = self.phone_encoder(text)
         midi_emb = self.midi_encoder_input_layer(midi)
 
-        hs_label, (_, _) = self.encoder(label_emb)
-        hs_midi, (_, _) = self.midi_encoder(midi_emb)
+        label_emb = self.length_regulator(phone_emb, ds)
+        # label_emb = self.enc_postnet(
+        #     phone_emb, label, text
+        # )
+
+        midi_emb = self.fc_midi(midi_emb)
 
         if self.embed_integration_type == "add":
-            hs = hs_label + hs_midi
-            hs = self.projection(hs)
+            hs = label_emb + midi_emb
         else:
-            hs = torch.cat((hs_label, hs_midi), dim=-1)
-            hs = self.projection(hs)
+            hs = torch.cat((label_emb, midi_emb), dim=-1)
+
+        # hs = F.leaky_relu(self.projection(hs))
 
-        # integrate spk & lang embeddings
-        if self.spks is not None:
-            sid_embs = self.sid_emb(sids.view(-1))
-            hs = hs + sid_embs.unsqueeze(1)
-        if self.langs is not None:
-            lid_embs = self.lid_emb(lids.view(-1))
-            hs = hs + lid_embs.unsqueeze(1)
+        # integrate spk & lang embeddings (and additive speaker embedding):
+        # sum the per-utterance vectors first, then add to all frames once
+        sid_embs = self.sid_emb(sids.view(-1)) if self.spks is not None else None
+        lid_embs = self.lid_emb(lids.view(-1)) if self.langs is not None else None
+        spk_embs = None
+        if self.spk_embed_dim is not None and self.spk_embed_integration_type == "add":
+            spk_embs = self.spk_projection(F.normalize(spembs))
+        hs = _add_utterance_embeddings(hs, sid_embs, lid_embs, spk_embs)
 
         # integrate speaker embedding
-        if self.spk_embed_dim is not None:
+        if self.spk_embed_dim is not None and self.spk_embed_integration_type != "add":
             hs = self._integrate_with_spk_embed(hs, spembs)
 
-        zs = torch.nn.utils.rnn.pack_padded_sequence(
-            hs, label_lengths, batch_first=True
-        )
+        if self.use_raw_pe:
+            # only depends on time, so fc_pos runs once on (1, T, embed_dim)
+            self.pos.extend_pe(hs)
+            pos_emb = self.pos.dropout(self.pos.pe[:, : hs.size(1)])
+        else:
+            pos_emb = self.pos(hs)
+        pos_out = self.fc_pos(pos_emb)
+
+        # hs is not saved for backward by anything above, so accumulate in place
+        hs += pos_out
+        return hs
+
+    def decode(
+        self, hs: torch.Tensor, midi_lengths: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Decode frame-level hidden states into acoustic features.
+        Args:
+            hs (Tensor): Batch of frame-level hidden states (B, Lmax, embed_dim).
+            midi_lengths (LongTensor): Batch of the lengths of each frame sequence (B,).
+
+        Returns:
+            Tensor: Batch of features before postnet (B, Lmax, odim).
+            Tensor: Batch of features after postnet (B, Lmax, odim).
+        """
+        # built on hs.device against hs.size(1): no host sync, no H2D copy
+        pos = torch.arange(hs.size(1), device=hs.device).unsqueeze(0)
+        pos = pos < midi_lengths.to(hs.device).unsqueeze(1)
+        zs = self.decoder.forward_hidden(hs, pos=pos)  # True mask
+
+        if self.reduction_factor > 1:
+            # one row-major (B, T_feats//r, eunits) input for the output GEMM
+            zs = zs[:, self.reduction_factor - 1 :: self.reduction_factor].contiguous()
+
+        # decoder.output_fc and feat_out have nothing in between, so apply them
+        # as a single linear: one GEMM over the frames instead of two
+        output_fc = self.decoder.output_fc
+        weight = torch.matmul(self.feat_out.weight, output_fc.weight)
+        bias = F.linear(output_fc.bias, self.feat_out.weight, self.feat_out.bias)
 
-        zs = zs[:, self.reduction_factor - 1 :: self.reduction_factor]
         # (B, T_feats//r, odim * r) -> (B, T_feats//r * r, odim)
-        before_outs = self.feat_out(zs).view(zs.size(0), -1, self.odim)
+        before_outs = F.leaky_relu(
+            F.linear(zs, weight, bias).view(zs.size(0), -1, self.odim), inplace=True
+        )
 
         # postnet -> (B, T_feats//r * r, odim)
         if self.postnet is None:
             after_outs = before_outs
         else:
-            after_outs = before_outs + self.postnet(
-                before_outs.transpose(1, 2)
-            ).transpose(1, 2)
+            after_outs = self.postnet(before_outs.transpose(1, 2)).transpose(1, 2)
+            after_outs += before_outs
 
-        return after_outs
+        return before_outs, after_outs
 
-    def _integrate_with_spk_embed(
-        self, hs: torch.Tensor, spembs: torch.Tensor
-    ) -> torch.Tensor:
-        """Integrate speaker embedding with hidden states.
+    def inference(
+        self,
+        text: torch.Tensor,
+        label: torch.Tensor,
+        midi: torch.Tensor,
+        ds: torch.Tensor,
+        feats: torch.Tensor = None,
+        tempo: Optional[torch.Tensor] = None,
+        spembs: Optional[torch.Tensor] = None,
+        sids: Optional[torch.Tensor] = None,
+        lids: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, Dict[str, torch.Tensor], torch.Tensor]:
+        """Calculate forward propagation.
         Args:
-            hs (Tensor): Batch of hidden state sequences (B, Tmax, adim).
-            spembs (Tensor): Batch of speaker embeddings (B, spk_embed_dim).
+            text (LongTensor): Batch of padded character ids (Tmax).
+            label (Tensor)
+            midi (Tensor)
+            ds (LongTensor): Batch of phone durations (Tmax).
+            feats (Tensor): Batch of padded target features (Lmax, odim).
+            spembs (Optional[Tensor]): Batch of speaker embeddings (spk_embed_dim).
+            sids (Optional[Tensor]): Batch of speaker IDs (1).
+            lids (Optional[Tensor]): Batch of language IDs (1).
+
         Returns:
-            Tensor: Batch of integrated hidden state sequences (B, Tmax, adim).
+            Dict[str, Tensor]: Output dict including the following items:
+                * feat_gen (Tensor): Output sequence of features (T_feats, odim).
         """
-        if self.spk_embed_integration_type == "add":
-            # apply projection and then add to hidden states
-            spembs = self.projection(F.normalize(spembs))
-            hs = hs + spembs.unsqueeze(1)
-        elif self.spk_embed_integration_type == "concat":
-            # concat hidden states with spk embeds and then apply projection
-            spembs = F.normalize(spembs).unsqueeze(1).expand(-1, hs.size(1), -1)
-            hs = self.projection(torch.cat([hs, spembs], dim=-1))
-        else:
-            raise NotImplementedError("support only add or concat.")
+        hs = self.encode(text, midi, ds, spembs=spembs, sids=sids, lids=lids)
+        # every frame of a single utterance is valid
+        midi_lengths = midi.new_full((midi.size(0),), midi.size(1))
+        _, after_outs = self.decode(hs, midi_lengths)
 
-        return hs
+        return after_outs, None, None  # outs, probs, att_ws
 
     def _integrate_with_spk_embed(
         self, hs: torch.Tensor, spembs: torch.Tensor
     ) -> torch.Tensor:
         """Integrate speaker embedding with hidden states.
         Args:
-            hs (Tensor): Batch of hidden state sequences (B, Tmax, eunits).
+            hs (Tensor): Batch of hidden state sequences (B, Tmax, adim).
             spembs (Tensor): Batch of speaker embeddings (B, spk_embed_dim).
         Returns:
-            Tensor: Batch of integrated hidden state sequences (B, Tmax, eunits) if
-                integration_type is "add" else (B, Tmax, eunits + spk_embed_dim).
+            Tensor: Batch of integrated hidden state sequences (B, Tmax, adim).
         """
         if self.spk_embed_integration_type == "add":
             # apply projection and then add to hidden states
-            spembs = self.projection(F.normalize(spembs))
+            spembs = self.spk_projection(F.normalize(spembs))
             hs = hs + spembs.unsqueeze(1)
         elif self.spk_embed_integration_type == "concat":
-            # concat hidden states with spk embeds
-            spembs = F.normalize(spembs).unsqueeze(1).expand(-1, hs.size(1), -1)
-            hs = torch.cat([hs, spembs], dim=-1)
+            # projection of [hs; spembs] on the two weight halves: the speaker
+            # half is normalized and projected once per utterance, not per frame
+            adim = hs.size(-1)
+            weight = self.spk_projection.weight
+            spembs = F.linear(
+                F.normalize(spembs), weight[:, adim:], self.spk_projection.bias
+            )
+            hs = F.linear(hs, weight[:, :adim]) + spembs.unsqueeze(1)
         else:
             raise NotImplementedError("support only add or concat.")
 
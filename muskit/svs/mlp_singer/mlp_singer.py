@@ -359,16 +359,18 @@ class MLPSinger(AbsSVS):
         text: torch.Tensor,
         label: torch.Tensor,
         midi: torch.Tensor,
+        ds: torch.Tensor = None,
         feats: torch.Tensor = None,
+        tempo: Optional[torch.Tensor] = None,
         spembs: Optional[torch.Tensor] = None,
         sids: Optional[torch.Tensor] = None,
         lids: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, Dict[str, torch.Tensor], torch.Tensor]:
         """Calculate forward propagation.
         Args:
-            text (LongTensor): Batch of padded character ids (Tmax).
-            label (Tensor)
-            midi (Tensor)
+            text (LongTensor): Batch of padded character ids (1, Tmax).
+            label (Tensor): Batch of frame-level phone ids (1, Lmax).
+            midi (Tensor): Batch of frame-level midi ids (1, Lmax).
             feats (Tensor): Batch of padded target features (Lmax, odim).
             spembs (Optional[Tensor]): Batch of speaker embeddings (spk_embed_dim).
             sids (Optional[Tensor]): Batch of speaker IDs (1).
@@ -378,11 +380,7 @@ class MLPSinger(AbsSVS):
             Dict[str, Tensor]: Output dict including the following items:
                 * feat_gen (Tensor): Output sequence of features (T_feats, odim).
         """
-        text = text.unsqueeze(0)  # for data-parallel
-        feats = feats.unsqueeze(0)  # for data-parallel
-        midi = midi.unsqueeze(0)  # for data-parallel
-        label = midi.unsqueeze(0)  # for data-parallel
-
+        # inputs arrive already batched (B=1) from MuskitSVSModel.inference
         label_emb = self.encoder_input_layer(label)
         midi_emb = self.midi_encoder_input_layer(midi)
 
@@ -419,7 +417,7 @@ class MLPSinger(AbsSVS):
                 before_outs.transpose(1, 2)
             ).transpose(1, 2)
 
-        return after_outs
+        return after_outs, None, None  # outs, probs, att_ws
 
     def _integrate_with_spk_embed(
         self, hs: torch.Tensor, spembs: torch.Tensor
@@ -3,7 +3,9 @@
 
 """Transformer-SVS related modules."""
 
+import copy
 from typing import Dict
+from typing import List
 from typing import Optional
 from typing import Sequence
 from typing import Tuple
@@ -28,6 +30,13 @@ from torch.distributions import Beta
 Beta_distribution = Beta(torch.tensor([0.5]), torch.tensor([0.5]))
 
 
+@torch.jit.script
+def _l2_normalize(x: torch.Tensor) -> torch.Tensor:
+    """Compute F.normalize(x, dim=-1) with rsqrt as one scripted (fusible) op."""
+    # clamp of the squared norm at eps ** 2 matches F.normalize(eps=1e-12)
+    return x * torch.rsqrt(x.mul(x).sum(-1, keepdim=True).clamp_min(1e-24))
+
+
 class NaiveRNNLoss(torch.nn.Module):
     """Loss function module for Tacotron2."""
 
@@ -110,6 +119,7 @@ class NaiveRNN(AbsSVS):
         eunits: int = 1024,
         ebidirectional: bool = True,
         midi_embed_integration_type: str = "add",
+        fused_dual_encoder: bool = False,
         dlayers: int = 3,
         dunits: int = 1024,
         dbidirectional: bool = True,
@@ -150,6 +160,11 @@ class NaiveRNN(AbsSVS):
         self.loss_type = loss_type
 
         self.midi_embed_integration_type = midi_embed_integration_type
+        self.fused_dual_encoder = fused_dual_encoder
+        if fused_dual_encoder and midi_embed_integration_type != "add":
+            raise ValueError(
+                "fused_dual_encoder requires midi_embed_integration_type='add'."
+            )
 
         # mixup - augmentation
         self.use_mixup_training = use_mixup_training
@@ -199,6 +214,10 @@ class NaiveRNN(AbsSVS):
                 padding_idx=self.padding_idx,
             )
 
+        if self.fused_dual_encoder:
+            # a single LSTM over the projected [label_emb; midi_emb] replaces
+            # the separate label / midi encoders
+            self.fuse_in = torch.nn.Linear(2 * eunits, eunits)
         self.encoder = torch.nn.LSTM(
             input_size=eunits,
             hidden_size=eunits,
@@ -209,15 +228,16 @@ class NaiveRNN(AbsSVS):
             # proj_size=eunits,
         )
 
-        self.midi_encoder = torch.nn.LSTM(
-            input_size=eunits,
-            hidden_size=eunits,
-            num_layers=elayers,
-            batch_first=True,
-            dropout=edropout_rate,
-            bidirectional=ebidirectional,
-            # proj_size=eunits,
-        )
+        if not self.fused_dual_encoder:
+            self.midi_encoder = torch.nn.LSTM(
+                input_size=eunits,
+                hidden_size=eunits,
+                num_layers=elayers,
+                batch_first=True,
+                dropout=edropout_rate,
+                bidirectional=ebidirectional,
+                # proj_size=eunits,
+            )
 
         dim_direction = 2 if ebidirectional == True else 1
         if self.midi_embed_integration_type == "add":
@@ -225,7 +245,7 @@ class NaiveRNN(AbsSVS):
                 eunits * dim_direction, eunits * dim_direction
             )
         else:
-            self.midi_projection = torch.nn.linear(
+            self.midi_projection = torch.nn.Linear(
                 2 * eunits * dim_direction, eunits * dim_direction
             )
 
@@ -295,6 +315,30 @@ class NaiveRNN(AbsSVS):
         if init_type != "pytorch":
             initialize(self, init_type)
 
+    def to_int8_cpu(self) -> torch.nn.Module:
+        """Return a copy with int8 dynamically quantized LSTMs and Linears.
+        This is meant for CPU inference (FBGEMM / oneDNN int8 kernels). The
+        postnet and prenet convolutions stay in fp32, since int8 Conv1d would
+        need static quantization with a calibration set.
+        Returns:
+            Module: Quantized copy of this model.
+        """
+        assert not self.training, "Quantize the model in eval mode."
+        model = copy.deepcopy(self).to("cpu")
+        qconfig_spec = {}
+        for name, m in model.named_modules():
+            if isinstance(m, torch.nn.LSTM):
+                m.flatten_parameters()
+            elif not isinstance(m, torch.nn.Linear):
+                continue
+            if name == "midi_projection" and self.midi_embed_integration_type != "add":
+                # _integrate_with_midi slices its float weight for concat
+                continue
+            qconfig_spec[name] = torch.quantization.default_dynamic_qconfig
+        return torch.quantization.quantize_dynamic(
+            model, qconfig_spec, dtype=torch.qint8
+        )
+
     def forward(
         self,
         text: torch.Tensor,
@@ -341,6 +385,11 @@ class NaiveRNN(AbsSVS):
         label = label[:, : label_lengths.max()]  # for data-parallel
         batch_size = feats.size(0)
 
+        # data-parallel replicas do not share the flattened weights
+        self.encoder.flatten_parameters()
+        if not self.fused_dual_encoder:
+            self.midi_encoder.flatten_parameters()
+
         label_emb = self.encoder_input_layer(label)  # FIX ME: label Float to Int
         midi_emb = self.midi_encoder_input_layer(midi)
 
@@ -425,32 +474,14 @@ class NaiveRNN(AbsSVS):
             batch_size_origin = batch_size
             batch_size = feats.size(0)
 
-        label_emb = torch.nn.utils.rnn.pack_padded_sequence(
-            label_emb, label_lengths.to("cpu"), batch_first=True, enforce_sorted=False
-        )
-        midi_emb = torch.nn.utils.rnn.pack_padded_sequence(
-            midi_emb, midi_lengths.to("cpu"), batch_first=True, enforce_sorted=False
-        )
-
-        hs_label, (_, _) = self.encoder(label_emb)
-        hs_midi, (_, _) = self.midi_encoder(midi_emb)
-
-        hs_label, _ = torch.nn.utils.rnn.pad_packed_sequence(hs_label, batch_first=True)
-        hs_midi, _ = torch.nn.utils.rnn.pad_packed_sequence(hs_midi, batch_first=True)
+        # pack_padded_sequence needs lengths on CPU: fetch both in one copy
+        label_lengths_cpu, midi_lengths_cpu = torch.stack(
+            [label_lengths, midi_lengths]
+        ).cpu()
 
-        if self.midi_embed_integration_type == "add":
-            hs = hs_label + hs_midi
-            hs = F.leaky_relu(self.midi_projection(hs))
-        else:
-            hs = torch.cat((hs_label, hs_midi), dim=-1)
-            hs = F.leaky_relu(self.midi_projection(hs))
+        hs = self._encode(label_emb, midi_emb, label_lengths_cpu, midi_lengths_cpu)
         # integrate spk & lang embeddings
-        if self.spks is not None:
-            sid_embs = self.sid_emb(sids.view(-1))
-            hs = hs + sid_embs.unsqueeze(1)
-        if self.langs is not None:
-            lid_embs = self.lid_emb(lids.view(-1))
-            hs = hs + lid_embs.unsqueeze(1)
+        hs = self._integrate_with_sid_lid_embeds(hs, sids, lids)
 
         # integrate speaker embedding
         if self.spk_embed_dim is not None:
@@ -467,25 +498,15 @@ class NaiveRNN(AbsSVS):
 
         # (B, T_feats//r, odim * r) -> (B, T_feats//r * r, odim)
         # before_outs = F.leaky_relu(self.feat_out(zs).view(zs.size(0), -1, self.odim))
-        before_outs = F.leaky_relu(self.feat_out(hs).view(hs.size(0), -1, self.odim))
-
-        # postnet -> (B, T_feats//r * r, odim)
-        if self.postnet is None:
-            after_outs = before_outs
-        else:
-            after_outs = before_outs + self.postnet(
-                before_outs.transpose(1, 2)
-            ).transpose(1, 2)
+        before_outs, after_outs = self._decode(hs)
 
         # modifiy mod part of groundtruth
         if self.reduction_factor > 1:
             assert feats_lengths.ge(
                 self.reduction_factor
             ).all(), "Output length must be greater than or equal to reduction factor."
-            olens = feats_lengths.new(
-                [olen - olen % self.reduction_factor for olen in feats_lengths]
-            )
-            max_olen = max(olens)
+            olens = feats_lengths - feats_lengths % self.reduction_factor
+            max_olen = int(olens.max())
             ys = feats[:, :max_olen]
         else:
             ys = feats
@@ -577,39 +598,195 @@ class NaiveRNN(AbsSVS):
         label_emb = self.encoder_input_layer(label)
         midi_emb = self.midi_encoder_input_layer(midi)
 
-        hs_label, (_, _) = self.encoder(label_emb)
-        hs_midi, (_, _) = self.midi_encoder(midi_emb)
+        hs = self._encode(label_emb, midi_emb)
+        # integrate spk & lang embeddings
+        hs = self._integrate_with_sid_lid_embeds(hs, sids, lids)
 
-        if self.midi_embed_integration_type == "add":
-            hs = hs_label + hs_midi
-            hs = F.leaky_relu(self.midi_projection(hs))
-        else:
-            hs = torch.cat((hs_label, hs_midi), dim=-1)
-            hs = F.leaky_relu(self.midi_projection(hs))
+        # integrate speaker embedding
+        if self.spk_embed_dim is not None:
+            hs = self._integrate_with_spk_embed(hs, spembs)
+
+        # (B, T_feats//r, adim) -> (B, T_feats//r * r, odim)
+        _, after_outs = self._decode(hs)
+
+        return after_outs, None, None  # outs, probs, att_ws
+
+    def inference_batch(
+        self,
+        label: List[torch.Tensor],
+        midi: List[torch.Tensor],
+        spembs: Optional[torch.Tensor] = None,
+        sids: Optional[torch.Tensor] = None,
+        lids: Optional[torch.Tensor] = None,
+    ) -> List[torch.Tensor]:
+        """Generate features for several utterances in one padded batch.
+        Running one batch instead of B single-utterance calls amortizes the
+        kernel launches. Frames within the postnet receptive field of each
+        utterance end may differ slightly from `inference`, since the postnet
+        sees the padding as in training.
+        Args:
+            label (List[Tensor]): List of label sequences (T_i,).
+            midi (List[Tensor]): List of midi sequences (T_i,).
+            spembs (Optional[Tensor]): Batch of speaker embeddings (B, spk_embed_dim).
+            sids (Optional[Tensor]): Batch of speaker IDs (B, 1).
+            lids (Optional[Tensor]): Batch of language IDs (B, 1).
+        Returns:
+            List[Tensor]: List of output sequences of features (T_i * r, odim).
+        """
+        assert len(label) == len(midi)
+        # pack_padded_sequence needs lengths on CPU: build them there directly
+        ilens = torch.tensor([x.size(0) for x in label], dtype=torch.long)
+        label = torch.nn.utils.rnn.pad_sequence(
+            label, batch_first=True, padding_value=self.padding_idx
+        )
+        midi = torch.nn.utils.rnn.pad_sequence(
+            midi, batch_first=True, padding_value=self.padding_idx
+        )
+
+        label_emb = self.encoder_input_layer(label)
+        midi_emb = self.midi_encoder_input_layer(midi)
+
+        hs = self._encode(label_emb, midi_emb, ilens, ilens)
         # integrate spk & lang embeddings
-        if self.spks is not None:
-            sid_embs = self.sid_emb(sids.view(-1))
-            hs = hs + sid_embs.unsqueeze(1)
-        if self.langs is not None:
-            lid_embs = self.lid_emb(lids.view(-1))
-            hs = hs + lid_embs.unsqueeze(1)
+        hs = self._integrate_with_sid_lid_embeds(hs, sids, lids)
 
         # integrate speaker embedding
         if self.spk_embed_dim is not None:
             hs = self._integrate_with_spk_embed(hs, spembs)
 
-        # (B, T_feats//r, odim * r) -> (B, T_feats//r * r, odim)
-        before_outs = F.leaky_relu(self.feat_out(hs).view(hs.size(0), -1, self.odim))
+        _, after_outs = self._decode(hs)
+
+        olens = (ilens * self.reduction_factor).tolist()
+        return [outs[:olen] for outs, olen in zip(after_outs, olens)]
+
+    def _decode(self, hs: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Predict features from hidden states and refine them with the postnet.
+        Args:
+            hs (Tensor): Batch of hidden state sequences (B, T_feats//r, adim).
+        Returns:
+            Tensor: Batch of outputs before postnet (B, T_feats//r * r, odim).
+            Tensor: Batch of outputs after postnet (B, T_feats//r * r, odim).
+        """
+        if self.reduction_factor == 1 and isinstance(self.feat_out, torch.nn.Linear):
+            # let the GEMM write (B, odim, T) so the postnet Conv1d reads it
+            # without a copy; both outputs are returned as transposed views
+            before_outs = torch.matmul(self.feat_out.weight, hs.transpose(1, 2))
+            before_outs += self.feat_out.bias.unsqueeze(-1)
+            F.leaky_relu(before_outs, inplace=True)
+        else:
+            # (B, T_feats//r, odim * r) -> (B, T_feats//r * r, odim)
+            before_outs = F.leaky_relu(
+                self.feat_out(hs).view(hs.size(0), -1, self.odim), inplace=True
+            ).transpose(1, 2)
 
-        # postnet -> (B, T_feats//r * r, odim)
         if self.postnet is None:
             after_outs = before_outs
         else:
-            after_outs = before_outs + self.postnet(
-                before_outs.transpose(1, 2)
-            ).transpose(1, 2)
+            # residual added in place into the fresh postnet output
+            after_outs = self.postnet(before_outs)
+            after_outs += before_outs
 
-        return after_outs, None, None  # outs, probs, att_ws
+        return before_outs.transpose(1, 2), after_outs.transpose(1, 2)
+
+    def _encode(
+        self,
+        label_emb: torch.Tensor,
+        midi_emb: torch.Tensor,
+        label_lengths: Optional[torch.Tensor] = None,
+        midi_lengths: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Encode label and midi embeddings into integrated hidden states.
+        Args:
+            label_emb (Tensor): Batch of label embeddings (B, Tmax, eunits).
+            midi_emb (Tensor): Batch of midi embeddings (B, Tmax, eunits).
+            label_lengths (Optional[LongTensor]): Batch of label lengths (B,) on CPU.
+            midi_lengths (Optional[LongTensor]): Batch of midi lengths (B,) on CPU.
+        Returns:
+            Tensor: Batch of integrated hidden state sequences (B, Tmax, adim).
+        """
+        if self.fused_dual_encoder:
+            xs = self.fuse_in(torch.cat([label_emb, midi_emb], dim=-1))
+            hs = self._run_encoder(self.encoder, xs, label_lengths)
+            return F.leaky_relu(self.midi_projection(hs))
+
+        hs_label = self._run_encoder(self.encoder, label_emb, label_lengths)
+        hs_midi = self._run_encoder(self.midi_encoder, midi_emb, midi_lengths)
+        return self._integrate_with_midi(hs_label, hs_midi)
+
+    def _run_encoder(
+        self,
+        encoder: torch.nn.LSTM,
+        xs: torch.Tensor,
+        ilens: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Run an encoder LSTM over a padded batch.
+        Args:
+            encoder (LSTM): Encoder to run.
+            xs (Tensor): Batch of padded input sequences (B, Tmax, eunits).
+            ilens (Optional[LongTensor]): Batch of lengths of each input sequence
+                (B,) on CPU. None means no padding.
+        Returns:
+            Tensor: Batch of padded output sequences (B, max(ilens), adim).
+        """
+        if ilens is None or bool((ilens == xs.size(1)).all()):
+            # no padding to skip (e.g. a single utterance): no pack / unpack copies
+            hs, (_, _) = encoder(xs)
+            return hs
+
+        xs = torch.nn.utils.rnn.pack_padded_sequence(
+            xs, ilens, batch_first=True, enforce_sorted=False
+        )
+        hs, (_, _) = encoder(xs)
+        hs, _ = torch.nn.utils.rnn.pad_packed_sequence(hs, batch_first=True)
+        return hs
+
+    def _integrate_with_midi(
+        self, hs_label: torch.Tensor, hs_midi: torch.Tensor
+    ) -> torch.Tensor:
+        """Integrate midi encoder outputs with label encoder outputs.
+        Args:
+            hs_label (Tensor): Batch of label encoder outputs (B, Tmax, adim).
+            hs_midi (Tensor): Batch of midi encoder outputs (B, Tmax, adim).
+        Returns:
+            Tensor: Batch of integrated hidden state sequences (B, Tmax, adim).
+        """
+        if self.midi_embed_integration_type == "add":
+            hs = self.midi_projection(hs_label + hs_midi)
+        else:
+            # projection of [hs_label; hs_midi] on the two weight halves,
+            # so the (B, Tmax, 2 * adim) concat is never materialized
+            adim = hs_label.size(-1)
+            weight = self.midi_projection.weight
+            hs = F.linear(
+                hs_midi, weight[:, adim:], self.midi_projection.bias
+            ) + F.linear(hs_label, weight[:, :adim])
+
+        return F.leaky_relu(hs)
+
+    def _integrate_with_sid_lid_embeds(
+        self,
+        hs: torch.Tensor,
+        sids: Optional[torch.Tensor] = None,
+        lids: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Add speaker ID and language ID embeddings to hidden states.
+        Args:
+            hs (Tensor): Batch of hidden state sequences (B, Tmax, adim).
+            sids (Optional[Tensor]): Batch of speaker IDs (B, 1).
+            lids (Optional[Tensor]): Batch of language IDs (B, 1).
+        Returns:
+            Tensor: Batch of integrated hidden state sequences (B, Tmax, adim).
+        """
+        # sum the per-utterance vectors first, then add to all frames once
+        embs = None
+        if self.spks is not None:
+            embs = self.sid_emb(sids.view(-1))
+        if self.langs is not None:
+            lid_embs = self.lid_emb(lids.view(-1))
+            embs = lid_embs if embs is None else embs + lid_embs
+        if embs is None:
+            return hs
+        return hs + embs.unsqueeze(1)
 
     def _integrate_with_spk_embed(
         self, hs: torch.Tensor, spembs: torch.Tensor
@@ -624,11 +801,11 @@ class NaiveRNN(AbsSVS):
         
         if self.spk_embed_integration_type == "add":
             # apply projection and then add to hidden states
-            spembs = self.projection(F.normalize(spembs))
+            spembs = self.projection(_l2_normalize(spembs))
             hs = hs + spembs.unsqueeze(1)
         elif self.spk_embed_integration_type == "concat":
             # concat hidden states with spk embeds and then apply projection
-            spembs = F.normalize(spembs).unsqueeze(1).expand(-1, hs.size(1), -1)
+            spembs = _l2_normalize(spembs).unsqueeze(1).expand(-1, hs.size(1), -1)
             hs = self.projection(torch.cat([hs, spembs], dim=-1))
         else:
             raise NotImplementedError("support only add or concat.")
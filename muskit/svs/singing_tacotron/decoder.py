@@ -498,6 +498,7 @@ class Decoder(torch.nn.Module):
         use_att_constraint=False,
         backward_window=None,
         forward_window=None,
+        stop_check_interval=1,
     ):
         """Generate the sequence of features given the sequences of characters.
 
@@ -515,6 +516,9 @@ class Decoder(torch.nn.Module):
                 Whether to apply attention constraint introduced in `Deep Voice 3`_.
             backward_window (int): Backward window size in attention constraint.
             forward_window (int): Forward window size in attention constraint.
+            stop_check_interval (int): The number of steps whose stop flags are
+                fetched to the host at once. Generation still stops at the same
+                step, but up to stop_check_interval - 1 extra steps are computed.
 
         Returns:
             Tensor: Output sequence of features (L, odim).
@@ -557,6 +561,7 @@ class Decoder(torch.nn.Module):
         # loop for an output sequence
         idx = 0
         outs, att_ws, probs = [], [], []
+        stops, n_checked, n_steps = [], 0, None
         while True:
             # updated index
             idx += self.reduction_factor
@@ -611,10 +616,19 @@ class Decoder(torch.nn.Module):
                 last_attended_idx = int(att_w.argmax())
 
             # check whether to finish generation
-            if int(sum(probs[-1] >= threshold)) > 0 or idx >= maxlen:
+            stops += [(probs[-1] >= threshold).any()]
+            if len(stops) % stop_check_interval != 0 and idx < maxlen:
+                continue
+            # a single device -> host copy of the stop flags since the last check
+            for i, stop in enumerate(torch.stack(stops[n_checked:]).tolist()):
+                step_idx = (n_checked + i + 1) * self.reduction_factor
                 # check mininum length
-                if idx < minlen:
-                    continue
+                if (stop or step_idx >= maxlen) and step_idx >= minlen:
+                    n_steps = n_checked + i + 1
+                    break
+            n_checked = len(stops)
+            if n_steps is not None:
+                outs, probs, att_ws = outs[:n_steps], probs[:n_steps], att_ws[:n_steps]
                 outs = torch.cat(outs, dim=2)  # (1, odim, L)
                 if self.postnet is not None:
                     outs = outs + self.postnet(outs)  # (1, odim, L)
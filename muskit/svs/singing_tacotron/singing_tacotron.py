@@ -3,6 +3,8 @@
 
 """Tacotron 2 related modules for ESPnet2."""
 
+from collections import OrderedDict
+from distutils.version import LooseVersion
 import logging
 from typing import Dict
 from typing import Optional
@@ -13,7 +15,7 @@ import torch
 import torch.nn.functional as F
 from typeguard import check_argument_types
 
-from muskit.torch_utils.nets_utils import make_pad_mask, make_non_pad_mask
+from muskit.torch_utils.nets_utils import make_non_pad_mask
 from muskit.layers.rnn.attentions import AttForwardTA
 from muskit.layers.rnn.attentions import AttForward
 from muskit.layers.rnn.attentions import AttLoc
@@ -29,6 +31,8 @@ from muskit.svs.gst.style_encoder import StyleEncoder
 from muskit.torch_utils.initialize import initialize
 from muskit.layers.transformer.attention import MultiHeadedAttention
 
+is_torch_2_2_plus = LooseVersion(torch.__version__) >= LooseVersion("2.2.0")
+
 
 class GuidedAttentionLoss(torch.nn.Module):
     """Guided attention loss function module.
@@ -44,7 +48,7 @@ class GuidedAttentionLoss(torch.nn.Module):
 
     """
 
-    def __init__(self, sigma=0.4, alpha=1.0, reset_always=True):
+    def __init__(self, sigma=0.4, alpha=1.0, reset_always=True, cache_size=32):
         """Initialize guided attention loss module.
 
         Args:
@@ -52,18 +56,22 @@ class GuidedAttentionLoss(torch.nn.Module):
                 how close attention to a diagonal.
             alpha (float, optional): Scaling coefficient (lambda).
             reset_always (bool, optional): Whether to always reset masks.
+            cache_size (int, optional): The number of (ilens, olens) combinations
+                whose masks are kept for reuse.
 
         """
         super(GuidedAttentionLoss, self).__init__()
         self.sigma = sigma
         self.alpha = alpha
         self.reset_always = reset_always
-        self.guided_attn_masks = None
-        self.masks = None
+        self.cache_size = cache_size
+        self._mask_cache = OrderedDict()
+        self.guided_attn_weights = None
+        self.n_valid = None
 
     def _reset_masks(self):
-        self.guided_attn_masks = None
-        self.masks = None
+        self.guided_attn_weights = None
+        self.n_valid = None
 
     def forward(self, att_ws, ilens, olens):
         """Calculate forward propagation.
@@ -77,28 +85,94 @@ class GuidedAttentionLoss(torch.nn.Module):
             Tensor: Guided attention loss value.
 
         """
-        if self.guided_attn_masks is None:
-            self.guided_attn_masks = self._make_guided_attention_masks(ilens, olens).to(
-                att_ws.device
-            )
-        if self.masks is None:
-            self.masks = self._make_masks(ilens, olens).to(att_ws.device)
-        losses = self.guided_attn_masks * att_ws
-        loss = torch.mean(losses.masked_select(self.masks))
+        if self.guided_attn_weights is None:
+            (
+                self.guided_attn_weights,
+                self.n_valid,
+            ) = self._get_guided_attn_weights(ilens, olens, att_ws.device, att_ws.dtype)
+        # mean over the non-padded part as a single dot product: the weights are
+        # zero on the padded part
+        loss = torch.dot(self.guided_attn_weights.reshape(-1), att_ws.reshape(-1))
+        loss = loss / self.n_valid
         if self.reset_always:
             self._reset_masks()
         return self.alpha * loss
 
-    def _make_guided_attention_masks(self, ilens, olens):
-        n_batches = len(ilens)
-        max_ilen = max(ilens)
-        max_olen = max(olens)
-        guided_attn_masks = torch.zeros((n_batches, max_olen, max_ilen))
-        for idx, (ilen, olen) in enumerate(zip(ilens, olens)):
-            guided_attn_masks[idx, :olen, :ilen] = self._make_guided_attention_mask(
-                ilen, olen, self.sigma
-            )
-        return guided_attn_masks
+    def _get_guided_attn_weights(self, ilens, olens, device, dtype=torch.float32):
+        """Get the masked guided attention weights, reusing cached ones.
+
+        Bucketed batches often repeat the same lengths, so the product of the
+        guided attention masks and the non-padded masks is cached per lengths,
+        together with the number of non-padded elements. The weights lie in
+        [0, 1), so they are kept in the dtype of the attention weights without
+        losing precision, and half precision attention weights are not upcast in
+        the loss. The mean is taken by the caller, since 1 / n_valid would
+        underflow in half precision.
+
+        Args:
+            ilens (LongTensor): Batch of input lenghts (B,).
+            olens (LongTensor): Batch of output lenghts (B,).
+            device (torch.device): Device of the attention weights.
+            dtype (torch.dtype): Dtype of the attention weights.
+
+        Returns:
+            Tensor: Masked guided attention weights (B, T_max_out, T_max_in).
+            int: Number of non-padded elements.
+
+        """
+        # a single device -> host copy of both lengths
+        ilens, olens = torch.stack(
+            [torch.as_tensor(ilens), torch.as_tensor(olens)]
+        ).tolist()
+        key = (tuple(ilens), tuple(olens), device, dtype)
+        if key in self._mask_cache:
+            self._mask_cache.move_to_end(key)
+            return self._mask_cache[key]
+
+        masks = self._make_masks(ilens, olens).to(device)
+        weights = self._make_guided_attention_masks(
+            ilens, olens, device, max_ilen=max(ilens), max_olen=max(olens)
+        )
+        n_valid = sum(ilen * olen for ilen, olen in zip(ilens, olens))
+        # cast only the [0, 1) values, 1 / n_valid is applied to the loss
+        weights = (weights * masks).to(dtype)
+        self._mask_cache[key] = (weights, n_valid)
+        if len(self._mask_cache) > self.cache_size:
+            self._mask_cache.popitem(last=False)
+        return weights, n_valid
+
+    def _make_guided_attention_masks(
+        self, ilens, olens, device=None, max_ilen=None, max_olen=None
+    ):
+        """Make guided attention masks for the whole batch at once.
+
+        The values outside of each (olen, ilen) region are not zero, but they are
+        removed by the non-padded masks of `_make_masks`.
+
+        Args:
+            ilens (LongTensor): Batch of input lenghts (B,).
+            olens (LongTensor): Batch of output lenghts (B,).
+            device (torch.device, optional): Device to build the masks on.
+            max_ilen (int, optional): Maximum of ilens if already known on host.
+            max_olen (int, optional): Maximum of olens if already known on host.
+
+        Returns:
+            Tensor: Guided attention masks (B, T_max_out, T_max_in).
+
+        """
+        ilens = torch.as_tensor(ilens, device=device).float()
+        olens = torch.as_tensor(olens, device=device).float()
+        if max_ilen is None:
+            max_ilen = int(ilens.max())
+        if max_olen is None:
+            max_olen = int(olens.max())
+        grid_in = torch.arange(max_ilen, device=ilens.device).float()
+        grid_out = torch.arange(max_olen, device=olens.device).float()
+        grid_in = grid_in.view(1, 1, -1) / ilens.view(-1, 1, 1)
+        grid_out = grid_out.view(1, -1, 1) / olens.view(-1, 1, 1)
+        return 1.0 - torch.exp(
+            -((grid_in - grid_out) ** 2) / (2 * (self.sigma ** 2))
+        )
 
     @staticmethod
     def _make_guided_attention_mask(ilen, olen, sigma):
@@ -126,10 +200,11 @@ class GuidedAttentionLoss(torch.nn.Module):
                     [0.8858, 0.5422, 0.0831]])
 
         """
-        grid_x, grid_y = torch.meshgrid(torch.arange(olen), torch.arange(ilen))
-        grid_x, grid_y = grid_x.float().to(olen.device), grid_y.float().to(ilen.device)
+        device = olen.device if isinstance(olen, torch.Tensor) else None
+        grid_in = torch.arange(int(ilen), device=device, dtype=torch.float32) / ilen
+        grid_out = torch.arange(int(olen), device=device, dtype=torch.float32) / olen
         return 1.0 - torch.exp(
-            -((grid_y / ilen - grid_x / olen) ** 2) / (2 * (sigma ** 2))
+            -((grid_in.unsqueeze(0) - grid_out.unsqueeze(1)) ** 2) / (2 * (sigma ** 2))
         )
 
     @staticmethod
@@ -175,7 +250,11 @@ class Tacotron2Loss(torch.nn.Module):
     """Loss function module for Tacotron2."""
 
     def __init__(
-        self, use_masking=True, use_weighted_masking=False, bce_pos_weight=20.0
+        self,
+        use_masking=True,
+        use_weighted_masking=False,
+        bce_pos_weight=20.0,
+        loss_type="L1+L2",
     ):
         """Initialize Tactoron2 loss module.
 
@@ -185,25 +264,28 @@ class Tacotron2Loss(torch.nn.Module):
             use_weighted_masking (bool):
                 Whether to apply weighted masking in loss calculation.
             bce_pos_weight (float): Weight of positive sample of stop token.
+            loss_type (str): How the caller combines the losses ("L1", "L2" or
+                "L1+L2"). The mean square error loss is only computed if used.
 
         """
         super(Tacotron2Loss, self).__init__()
         assert (use_masking != use_weighted_masking) or not use_masking
         self.use_masking = use_masking
         self.use_weighted_masking = use_weighted_masking
+        self.compute_mse = loss_type in ("L1+L2", "L2")
 
         # define criterions
-        reduction = "none" if self.use_weighted_masking else "mean"
-        self.l1_criterion = torch.nn.L1Loss(reduction=reduction)
-        self.mse_criterion = torch.nn.MSELoss(reduction=reduction)
+        # NOTE: reduced in forward, so that masking needs no masked_select
+        self.l1_criterion = torch.nn.L1Loss(reduction="none")
+        self.mse_criterion = torch.nn.MSELoss(reduction="none")
         self.bce_criterion = torch.nn.BCEWithLogitsLoss(
-            reduction=reduction, pos_weight=torch.tensor(bce_pos_weight)
+            reduction="none", pos_weight=torch.tensor(bce_pos_weight)
         )
 
         # NOTE(kan-bayashi): register pre hook function for the compatibility
         self._register_load_state_dict_pre_hook(self._load_state_dict_pre_hook)
 
-    def forward(self, after_outs, before_outs, logits, ys, labels, olens):
+    def forward(self, after_outs, before_outs, logits, ys, labels, olens, masks=None):
         """Calculate forward propagation.
 
         Args:
@@ -213,44 +295,57 @@ class Tacotron2Loss(torch.nn.Module):
             ys (Tensor): Batch of padded target features (B, Lmax, odim).
             labels (LongTensor): Batch of the sequences of stop token labels (B, Lmax).
             olens (LongTensor): Batch of the lengths of each target (B,).
+            masks (BoolTensor, optional): Batch of masks indicating the non-padded
+                part of the targets (B, Lmax). Made from olens if not given.
 
         Returns:
             Tensor: L1 loss value.
-            Tensor: Mean square error loss value.
+            Tensor: Mean square error loss value (zero if not used by loss_type).
             Tensor: Binary cross entropy loss value.
 
         """
-        # make mask and apply it
-        if self.use_masking:
-            masks = make_non_pad_mask(olens).unsqueeze(-1).to(ys.device)
-            ys = ys.masked_select(masks)
-            after_outs = after_outs.masked_select(masks)
-            before_outs = before_outs.masked_select(masks)
-            labels = labels.masked_select(masks[:, :, 0])
-            logits = logits.masked_select(masks[:, :, 0])
-
         # calculate loss
         l1_loss = self.l1_criterion(after_outs, ys) + self.l1_criterion(before_outs, ys)
-        mse_loss = self.mse_criterion(after_outs, ys) + self.mse_criterion(
-            before_outs, ys
-        )
+        mse_loss = None
+        if self.compute_mse:
+            mse_loss = self.mse_criterion(after_outs, ys) + self.mse_criterion(
+                before_outs, ys
+            )
         bce_loss = self.bce_criterion(logits, labels)
 
+        if masks is None and (self.use_masking or self.use_weighted_masking):
+            masks = make_non_pad_mask(olens).to(ys.device)
+
+        # make mask and apply it
+        if self.use_masking:
+            # mean over the non-padded part as a static-shape masked sum
+            masks = masks.unsqueeze(-1).to(ys.dtype)
+            n_frames = masks.sum()
+            l1_loss = (l1_loss * masks).sum() / (n_frames * ys.size(2))
+            if mse_loss is not None:
+                mse_loss = (mse_loss * masks).sum() / (n_frames * ys.size(2))
+            bce_loss = (bce_loss * masks.squeeze(-1)).sum() / n_frames
+        elif not self.use_weighted_masking:
+            l1_loss = l1_loss.mean()
+            if mse_loss is not None:
+                mse_loss = mse_loss.mean()
+            bce_loss = bce_loss.mean()
+
         # make weighted mask and apply it
         if self.use_weighted_masking:
-            masks = make_non_pad_mask(olens).unsqueeze(-1).to(ys.device)
-            weights = masks.float() / masks.sum(dim=1, keepdim=True).float()
+            masks = masks.unsqueeze(-1).to(ys.dtype)
+            weights = masks / masks.sum(dim=1, keepdim=True)
             out_weights = weights.div(ys.size(0) * ys.size(2))
             logit_weights = weights.div(ys.size(0))
 
-            # apply weight
-            l1_loss = l1_loss.mul(out_weights).masked_select(masks).sum()
-            mse_loss = mse_loss.mul(out_weights).masked_select(masks).sum()
-            bce_loss = (
-                bce_loss.mul(logit_weights.squeeze(-1))
-                .masked_select(masks.squeeze(-1))
-                .sum()
-            )
+            # apply weight (the weights are zero on the padded part)
+            l1_loss = l1_loss.mul(out_weights).sum()
+            if mse_loss is not None:
+                mse_loss = mse_loss.mul(out_weights).sum()
+            bce_loss = bce_loss.mul(logit_weights.squeeze(-1)).sum()
+
+        if mse_loss is None:
+            mse_loss = l1_loss.new_zeros(())
 
         return l1_loss, mse_loss, bce_loss
 
@@ -337,6 +432,10 @@ class singing_tacotron(AbsSVS):
         use_guided_attn_loss (bool, optional): Whether to use guided attention loss.
         guided_attn_loss_sigma (float, optional): Sigma in guided attention loss.
         guided_attn_loss_lamdba (float, optional): Lambda in guided attention loss.
+        use_compile (bool, optional): Whether to compile the Tacotron2 loss and the
+            input embeddings with torch.compile (torch>=2.2.0).
+        inference_cache_size (int, optional): The number of scores whose encoder
+            outputs are kept for reuse in inference (0 to disable).
 
     """
 
@@ -389,6 +488,8 @@ class singing_tacotron(AbsSVS):
         use_guided_attn_loss: bool = True,
         guided_attn_loss_sigma: float = 0.4,
         guided_attn_loss_lambda: float = 1.0,
+        use_compile: bool = False,
+        inference_cache_size: int = 0,
         # extra embedding related
         spks: Optional[int] = None,
         langs: Optional[int] = None,
@@ -569,12 +670,27 @@ class singing_tacotron(AbsSVS):
             use_masking=use_masking,
             use_weighted_masking=use_weighted_masking,
             bce_pos_weight=bce_pos_weight,
+            loss_type=loss_type,
         )
         if self.use_guided_attn_loss:
             self.attn_loss = GuidedAttentionLoss(
                 sigma=guided_attn_loss_sigma,
                 alpha=guided_attn_loss_lambda,
             )
+        if use_compile:
+            if not is_torch_2_2_plus:
+                raise RuntimeError("Require torch>=2.2.0 for use_compile")
+            # compile in place, so that the state dict keys are unchanged.
+            # the guided attention loss is left as is: its mask cache runs in python
+            # and the loss itself is already a single dot product.
+            self.taco2_loss.compile(dynamic=True)
+            # fuse the four embedding lookups with their concatenation
+            self._embed_inputs = torch.compile(self._embed_inputs, dynamic=True)
+
+        # encoder outputs in inference, keyed by the input score
+        self.inference_cache_size = inference_cache_size
+        self._encoder_cache = OrderedDict()
+        self._register_load_state_dict_pre_hook(self._clear_encoder_cache)
 
         # initialize parameters
 #         self._reset_parameters(
@@ -621,26 +737,28 @@ class singing_tacotron(AbsSVS):
             Tensor: Weight value.
 
         """
-        text = text[:, : text_lengths.max()]  # for data-parallel
-        feats = feats[:, : feats_lengths.max()]  # for data-parallel
-        midi = midi[:, : midi_lengths.max()]  # for data-parallel
-        label = label[:, : label_lengths.max()]  # for data-parallel
-        tempo = tempo[:, : tempo_lengths.max()]  # for data-parallel
+        # for data-parallel: fetch all max lengths with a single device -> host copy
+        max_text, max_feats, max_midi, max_label, max_tempo = torch.stack(
+            [
+                text_lengths.max(),
+                feats_lengths.max(),
+                midi_lengths.max(),
+                label_lengths.max(),
+                tempo_lengths.max(),
+            ]
+        ).tolist()
+        text = text[:, :max_text]
+        feats = feats[:, :max_feats]
+        midi = midi[:, :max_midi]
+        label = label[:, :max_label]
+        tempo = tempo[:, :max_tempo]
 
         batch_size = text.size(0)
 
-        label_emb = self.phone_encode_layer(label)
-        midi_emb = self.midi_encode_layer(midi)
-        tempo_emb = self.tempo_encode_layer(tempo) # FIX ME (Nan): the tempo of singing tacotron is BPM, should change later.
-        ds_tensor = torch.tensor(ds.unsqueeze(-1),dtype=torch.float32).cuda()
-        ds_emb = self.duration_encode_layer(ds_tensor)
-        
-        content_input = torch.cat([label_emb, midi_emb], dim=-1) # cat this two or cat 4 into content_enc
-        duration_tempo = torch.cat([tempo_emb, ds_emb], dim=-1)
-        
-        att_input = None
-        if self.atype != "GDCA_location":
-            att_input = torch.cat([content_input, duration_tempo], dim=-1)
+        assert ds.device == text.device, "ds must be on the same device as text."
+        content_input, duration_tempo, att_input = self._embed_inputs(
+            label, midi, tempo, ds
+        )
 
         # TODO (Nan): add start & End token
         # # Add eos at the last of sequence
@@ -655,8 +773,9 @@ class singing_tacotron(AbsSVS):
 
         # make labels for stop prediction  
         # TODO: (Nan) change name
-        stop_labels = make_pad_mask(olens - 1).to(ys.device, ys.dtype)
-        stop_labels = F.pad(stop_labels, [0, 1], "constant", 1.0)
+        # 1 from the last frame of each target on: a single comparison, no pad
+        frame_idx = torch.arange(ys.size(1), device=ys.device)
+        stop_labels = (frame_idx.unsqueeze(0) >= (olens - 1).unsqueeze(1)).to(ys.dtype)
 
         # calculate tacotron2 outputs
         after_outs, before_outs, logits, att_ws = self._forward(
@@ -665,8 +784,8 @@ class singing_tacotron(AbsSVS):
 
         # modify mod part of groundtruth
         if self.reduction_factor > 1:
-            olens = olens.new([olen - olen % self.reduction_factor for olen in olens])
-            max_out = max(olens)
+            olens = olens - olens % self.reduction_factor
+            max_out = int(olens.max())
             ys = ys[:, :max_out]
             stop_labels = stop_labels[:, :max_out]
             stop_labels[:, -1] = 1.0  # make sure at least one frame has 1
@@ -675,8 +794,9 @@ class singing_tacotron(AbsSVS):
             olens = feats_lengths
 
         # calculate taco2 loss
+        masks = frame_idx[: ys.size(1)].unsqueeze(0) < olens.unsqueeze(1)
         l1_loss, mse_loss, bce_loss = self.taco2_loss(
-            after_outs, before_outs, logits, ys, stop_labels, olens
+            after_outs, before_outs, logits, ys, stop_labels, olens, masks=masks
         )
         if self.loss_type == "L1+L2":
             loss = l1_loss + mse_loss + bce_loss
@@ -688,24 +808,25 @@ class singing_tacotron(AbsSVS):
             raise ValueError(f"unknown --loss-type {self.loss_type}")
 
         stats = dict(
-            l1_loss=l1_loss.item(),
-            mse_loss=mse_loss.item(),
-            bce_loss=bce_loss.item(),
+            l1_loss=l1_loss.detach(),
+            bce_loss=bce_loss.detach(),
         )
+        if self.taco2_loss.compute_mse:
+            stats.update(mse_loss=mse_loss.detach())
 
         # calculate attention loss
         if self.use_guided_attn_loss:
             # NOTE(kan-bayashi): length of output for auto-regressive
             # input will be changed when r > 1
             if self.reduction_factor > 1:
-                olens_in = olens.new([olen // self.reduction_factor for olen in olens])
+                olens_in = olens // self.reduction_factor
             else:
                 olens_in = olens
             attn_loss = self.attn_loss(att_ws, ilens, olens_in)
             loss = loss + attn_loss
-            stats.update(attn_loss=attn_loss.item())
+            stats.update(attn_loss=attn_loss.detach())
 
-        stats.update(loss=loss.item())
+        stats.update(loss=loss.detach())
 
         loss, stats, weight = force_gatherable((loss, stats, batch_size), loss.device)
         
@@ -716,6 +837,46 @@ class singing_tacotron(AbsSVS):
             # validation stage
             return loss, stats, weight, after_outs[:, : olens.max()], ys, olens
 
+    def _embed_inputs(
+        self,
+        label: torch.Tensor,
+        midi: torch.Tensor,
+        tempo: torch.Tensor,
+        ds: torch.Tensor,
+    ) -> Tuple[Optional[torch.Tensor], Optional[torch.Tensor], Optional[torch.Tensor]]:
+        """Embed the music score inputs for the encoders.
+
+        Only the inputs used by the attention type are built, each with a single
+        concatenation of the embeddings.
+
+        Args:
+            label (LongTensor): Batch of padded phone ids (B, Tmax).
+            midi (LongTensor): Batch of padded midi ids (B, Tmax).
+            tempo (LongTensor): Batch of padded tempo ids (B, Tmax).
+            ds (LongTensor): Batch of padded durations (B, Tmax).
+
+        Returns:
+            Tensor: Content encoder input (B, Tmax, 2 * embed_dim) or None.
+            Tensor: Duration encoder input (B, Tmax, 2 * embed_dim) or None.
+            Tensor: Content encoder input for non-GDCA attention
+                (B, Tmax, 4 * embed_dim) or None.
+
+        """
+        label_emb = self.phone_encode_layer(label)
+        midi_emb = self.midi_encode_layer(midi)
+        tempo_emb = self.tempo_encode_layer(tempo) # FIX ME (Nan): the tempo of singing tacotron is BPM, should change later.
+        ds_tensor = ds.unsqueeze(-1).to(dtype=torch.float32, non_blocking=True)
+        ds_emb = self.duration_encode_layer(ds_tensor)
+
+        if self.atype != "GDCA_location":
+            # only the concatenation of all four embeddings is used
+            att_input = torch.cat([label_emb, midi_emb, tempo_emb, ds_emb], dim=-1)
+            return None, None, att_input
+
+        content_input = torch.cat([label_emb, midi_emb], dim=-1)
+        duration_tempo = torch.cat([tempo_emb, ds_emb], dim=-1)
+        return content_input, duration_tempo, None
+
     def _forward(
         self,
         xs: torch.Tensor,
@@ -756,6 +917,7 @@ class singing_tacotron(AbsSVS):
         use_teacher_forcing: bool = False,
         tempo: Optional[torch.Tensor] = None,
         spembs: Optional[torch.Tensor] = None,
+        stop_check_interval: int = 1,
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """Generate the sequence of features given the sequences of characters.
 
@@ -774,6 +936,8 @@ class singing_tacotron(AbsSVS):
             backward_window (int, optional): Backward window in attention constraint.
             forward_window (int, optional): Forward window in attention constraint.
             use_teacher_forcing (bool, optional): Whether to use teacher forcing.
+            stop_check_interval (int, optional): The number of decoder steps whose
+                stop flags are fetched to the host at once.
 
         Returns:
             Tensor: Output sequence of features (L, odim).
@@ -781,20 +945,6 @@ class singing_tacotron(AbsSVS):
             Tensor: Attention weights (L, T).
 
         """
-        label_emb = self.phone_encode_layer(label)
-        midi_emb = self.midi_encode_layer(midi)
-        tempo_emb = self.tempo_encode_layer(tempo) # FIX ME (Nan): the tempo of singing tacotron is BPM, should change later.
-        ds_tensor = torch.as_tensor(ds.unsqueeze(-1),dtype=torch.float32).to(midi.device)
-#         ds_tensor = ds.unsqueeze(-1).to(midi.device).to(dtype=torch.float32)
-        ds_emb = self.duration_encode_layer(ds_tensor)
-        
-        content_input = torch.cat([label_emb, midi_emb], dim=-1) # cat this two or cat 4 into content_enc
-        duration_tempo = torch.cat([tempo_emb, ds_emb], dim=-1)
-
-        att_input = None
-        if self.atype != "GDCA_location":
-            att_input = torch.cat([content_input, duration_tempo], dim=-1)
-
         x = text
         y = feats
         spemb = spembs
@@ -816,13 +966,8 @@ class singing_tacotron(AbsSVS):
             return outs[0], None, att_ws[0]
 
         # inference
-        if self.atype == "GDCA_location":
-            h = self.enc_content.inference(content_input) # h: (B, seq_len, emb_dim)
-            trans_token = self.enc_duration.inference(duration_tempo) # (B, seq_len, 1)
-        else:
-            h = self.enc_content.inference(att_input) # hs: (B, seq_len, emb_dim)
-            trans_token = None
-            
+        h, trans_token = self._encode_inference(label, midi, tempo, ds)
+
         # integrate with SID and LID embeddings
         if self.spks is not None:
             sid_embs = self.sid_emb(sids.view(-1))
@@ -831,16 +976,12 @@ class singing_tacotron(AbsSVS):
             lid_embs = self.lid_emb(lids.view(-1))
             h = h + lid_embs.unsqueeze(1)
             
-        # integrate speaker embedding
-        if self.spk_embed_dim is not None:
-            h = self._integrate_with_spk_embed(h, spembs)
-            
         if self.use_gst:
             style_emb = self.gst(y.unsqueeze(0))
             h = h + style_emb
+        # integrate speaker embedding once, after GST as in training
         if self.spk_embed_dim is not None:
-            hs, spembs = h.unsqueeze(0), spemb.unsqueeze(0)
-            h = self._integrate_with_spk_embed(hs, spembs)[0]
+            h = self._integrate_with_spk_embed(h, spemb.unsqueeze(0))
         outs, probs, att_ws = self.dec.inference(
             h,
             trans_token,
@@ -850,10 +991,68 @@ class singing_tacotron(AbsSVS):
             use_att_constraint=use_att_constraint,
             backward_window=backward_window,
             forward_window=forward_window,
+            stop_check_interval=stop_check_interval,
         )
 
         return outs, probs, att_ws
 
+    def _encode_inference(
+        self,
+        label: torch.Tensor,
+        midi: torch.Tensor,
+        tempo: torch.Tensor,
+        ds: torch.Tensor,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Encode the music score in inference.
+
+        Args:
+            label (LongTensor): Phone ids (1, T).
+            midi (LongTensor): Midi ids (1, T).
+            tempo (LongTensor): Tempo ids (1, T).
+            ds (LongTensor): Durations (1, T).
+
+        Returns:
+            Tensor: Encoder hidden states (1, T, eunits).
+            Tensor: Transition token for GDCA attention (1, T, 1) or None.
+
+        """
+        key = None
+        if self.inference_cache_size > 0:
+            key = tuple(tuple(x.reshape(-1).tolist()) for x in (label, midi, tempo, ds))
+            if key in self._encoder_cache:
+                self._encoder_cache.move_to_end(key)
+                return self._encoder_cache[key]
+
+        content_input, duration_tempo, att_input = self._embed_inputs(
+            label, midi, tempo, ds.to(midi.device, non_blocking=True)
+        )
+        if self.atype == "GDCA_location":
+            h = self.enc_content.inference(content_input)
+            trans_token = self.enc_duration.inference(duration_tempo)
+        else:
+            h = self.enc_content.inference(att_input)
+            trans_token = None
+
+        if key is not None:
+            self._encoder_cache[key] = (h, trans_token)
+            if len(self._encoder_cache) > self.inference_cache_size:
+                self._encoder_cache.popitem(last=False)
+        return h, trans_token
+
+    def train(self, mode: bool = True):
+        """Set the training mode, dropping the cached encoder outputs."""
+        self._encoder_cache.clear()
+        return super().train(mode)
+
+    def _apply(self, *args, **kwargs):
+        # cached outputs would keep the old device / dtype after .to() / .half()
+        self._encoder_cache.clear()
+        return super()._apply(*args, **kwargs)
+
+    def _clear_encoder_cache(self, *args, **kwargs):
+        """Drop the cached encoder outputs before loading parameters."""
+        self._encoder_cache.clear()
+
     def _integrate_with_spk_embed(
         self, hs: torch.Tensor, spembs: torch.Tensor
     ) -> torch.Tensor:
@@ -868,13 +1067,14 @@ class singing_tacotron(AbsSVS):
                 integration_type is "add" else (B, Tmax, eunits + spk_embed_dim).
 
         """
+        spembs = F.normalize(spembs)
         if self.spk_embed_integration_type == "add":
             # apply projection and then add to hidden states
-            spembs = self.projection(F.normalize(spembs))
+            spembs = self.projection(spembs)
             hs = hs + spembs.unsqueeze(1)
         elif self.spk_embed_integration_type == "concat":
             # concat hidden states with spk embeds
-            spembs = F.normalize(spembs).unsqueeze(1).expand(-1, hs.size(1), -1)
+            spembs = spembs.unsqueeze(1).expand(-1, hs.size(1), -1)
             hs = torch.cat([hs, spembs], dim=-1)
         else:
             raise NotImplementedError("support only add or concat.")
@@ -465,6 +465,13 @@ class AbsTask(ABC):
             default=True,
             help="Enable cudnn-deterministic mode",
         )
+        group.add_argument(
+            "--allow_tf32",
+            type=str2bool,
+            default=False,
+            help="Allow TF32 tensor cores for float32 matmul on Ampere or newer GPUs. "
+            "This feature requires pytorch>=1.7",
+        )
 
         group = parser.add_argument_group("collect stats mode related")
         group.add_argument(
@@ -606,6 +613,13 @@ class AbsTask(ABC):
             default=False,
             help="Enable Automatic Mixed Precision. This feature requires pytorch>=1.6",
         )
+        group.add_argument(
+            "--amp_dtype",
+            default="float16",
+            choices=["float16", "bfloat16"],
+            help="Data type used by Automatic Mixed Precision. "
+            "bfloat16 does not need loss scaling and requires pytorch>=1.10",
+        )
         group.add_argument(
             "--log_interval",
             type=int_or_none,
@@ -1131,6 +1145,8 @@ class AbsTask(ABC):
         torch.backends.cudnn.enabled = args.cudnn_enabled
         torch.backends.cudnn.benchmark = args.cudnn_benchmark
         torch.backends.cudnn.deterministic = args.cudnn_deterministic
+        if args.allow_tf32:
+            torch.backends.cuda.matmul.allow_tf32 = True
         if args.detect_anomaly:
             logging.info("Invoking torch.autograd.set_detect_anomaly(True)")
             torch.autograd.set_detect_anomaly(args.detect_anomaly)
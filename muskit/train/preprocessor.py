@@ -1,5 +1,7 @@
 from abc import ABC
 from abc import abstractmethod
+from distutils.version import LooseVersion
+import functools
 from pathlib import Path
 from typing import Collection
 from typing import Dict
@@ -10,7 +12,6 @@ import logging
 import numpy as np
 import scipy.signal
 import soundfile
-import random
 import pytsmod as tsm
 from typeguard import check_argument_types
 from typeguard import check_return_type
@@ -19,6 +20,8 @@ from muskit.text.build_tokenizer import build_tokenizer
 from muskit.text.cleaner import TextCleaner
 from muskit.text.token_id_converter import TokenIDConverter
 
+is_numpy_1_20_plus = LooseVersion(np.__version__) >= LooseVersion("1.20.0")
+
 
 class AbsPreprocessor(ABC):
     def __init__(self, train: bool):
@@ -64,19 +67,33 @@ def framing(
         pad_shape = [(0, 0) for _ in range(x.ndim - 1)] + [(0, nadd)]
         x = np.pad(x, pad_shape, mode="constant", constant_values=0)
 
-    # Created strided array of data segments
+    # Created strided array of data segments (a read-only view)
     if frame_length == 1 and frame_length == frame_shift:
         result = x[..., None]
+    elif is_numpy_1_20_plus:
+        result = np.lib.stride_tricks.sliding_window_view(x, frame_length, axis=-1)[
+            ..., ::frame_shift, :
+        ]
     else:
         shape = x.shape[:-1] + (
             (x.shape[-1] - frame_length) // frame_shift + 1,
             frame_length,
         )
         strides = x.strides[:-1] + (frame_shift * x.strides[-1], x.strides[-1])
-        result = np.lib.stride_tricks.as_strided(x, shape=shape, strides=strides)
+        result = np.lib.stride_tricks.as_strided(
+            x, shape=shape, strides=strides, writeable=False
+        )
     return result
 
 
+@functools.lru_cache(maxsize=None)
+def _get_squared_window(window: str, frame_length: int, dtype: np.dtype) -> np.ndarray:
+    window = scipy.signal.get_window(window, frame_length).astype(dtype) ** 2
+    # shared between calls
+    window.flags.writeable = False
+    return window
+
+
 def detect_non_silence(
     x: np.ndarray,
     threshold: float = 0.01,
@@ -100,17 +117,30 @@ def detect_non_silence(
 
     if x.dtype.kind == "i":
         x = x.astype(np.float64)
-    # framed_w: (C, T, F)
-    framed_w = framing(
+    # framed: (C, T, F)
+    framed = framing(
         x,
         frame_length=frame_length,
         frame_shift=frame_shift,
         centered=False,
         padded=True,
     )
-    framed_w *= scipy.signal.get_window(window, frame_length).astype(framed_w.dtype)
     # power: (C, T)
-    power = (framed_w**2).mean(axis=-1)
+    # The windowed frames are squared and averaged in one pass,
+    # without materializing them (the frames overlap in the strided view)
+    if window == "boxcar":
+        # all ones: skip the window
+        power = np.einsum("...tf,...tf->...t", framed, framed) / frame_length
+    else:
+        power = (
+            np.einsum(
+                "...tf,...tf,f->...t",
+                framed,
+                framed,
+                _get_squared_window(window, frame_length, framed.dtype),
+            )
+            / frame_length
+        )
     # mean_power: (C,)
     mean_power = power.mean(axis=-1)
     if np.all(mean_power == 0):
@@ -131,6 +161,47 @@ def detect_non_silence(
     )
 
 
+def _non_silence_power(x: np.ndarray, detects: np.ndarray) -> float:
+    """Mean power of the non-silence samples, without gathering them.
+
+    Args:
+        x: (Channel, Time)
+        detects: (Channel, Time) or broadcastable to it
+
+    """
+    detects = np.broadcast_to(detects, x.shape)
+    return np.vdot(x * detects, x) / int(np.count_nonzero(detects))
+
+
+@functools.lru_cache(maxsize=512)
+def _read_rir(path: str) -> np.ndarray:
+    """Read a RIR file once per process.
+
+    Returns:
+        rir: (Nmic, Time)
+
+    """
+    rir, _ = soundfile.read(path, dtype=np.float32, always_2d=True)
+    rir = np.ascontiguousarray(rir.T)
+    # shared between calls
+    rir.flags.writeable = False
+    return rir
+
+
+@functools.lru_cache(maxsize=512)
+def _read_noise(path: str) -> np.ndarray:
+    """Read a whole noise file once per process.
+
+    Returns:
+        noise: (Time, Nmic)
+
+    """
+    noise, _ = soundfile.read(path, dtype=np.float32, always_2d=True)
+    # shared between calls
+    noise.flags.writeable = False
+    return noise
+
+
 class CommonPreprocessor(AbsPreprocessor):
     def __init__(
         self,
@@ -155,6 +226,7 @@ class CommonPreprocessor(AbsPreprocessor):
         label_name: str = "label",
         midi_name: str = "midi",
         fs: np.int32 = 0,
+        text_cache_size: int = 100000,
     ):
         super().__init__(train)
         self.train = train
@@ -184,10 +256,19 @@ class CommonPreprocessor(AbsPreprocessor):
                 token_list=token_list,
                 unk_symbol=unk_symbol,
             )
+            # vowel ids for the phone-level augmentation anchors
+            self.vowel_ints = np.array(
+                self.token_id_converter.tokens2ids(["a", "e", "i", "o", "u"]),
+                dtype=np.int64,
+            )
         else:
             self.text_cleaner = None
             self.tokenizer = None
             self.token_id_converter = None
+            self.vowel_ints = None
+        # text -> token ids of the texts seen so far (per DataLoader worker)
+        self.text_cache_size = text_cache_size
+        self._text_cache = {}
 
         if train and rir_scp is not None:
             self.rirs = []
@@ -210,6 +291,8 @@ class CommonPreprocessor(AbsPreprocessor):
                         self.noises.append(sps[0])
                     else:
                         self.noises.append(sps[1])
+            # the lengths decide between a whole (cached) and a windowed read
+            self.noise_frames = [soundfile.info(path).frames for path in self.noises]
             sps = noise_db_range.split("_")
             if len(sps) == 1:
                 self.noise_db_low, self.noise_db_high = float(sps[0])
@@ -222,6 +305,20 @@ class CommonPreprocessor(AbsPreprocessor):
         else:
             self.noises = None
 
+    def _text2ints(self, text: str) -> np.ndarray:
+        """Clean, tokenize and convert text to token ids, reusing earlier results."""
+        text_ints = self._text_cache.get(text)
+        if text_ints is None:
+            tokens = self.tokenizer.text2tokens(self.text_cleaner(text))
+            text_ints = np.array(
+                self.token_id_converter.tokens2ids(tokens), dtype=np.int64
+            )
+            # shared between calls
+            text_ints.flags.writeable = False
+            if len(self._text_cache) < self.text_cache_size:
+                self._text_cache[text] = text_ints
+        return text_ints
+
     def __call__(
         self,
         uid: str,
@@ -244,69 +341,65 @@ class CommonPreprocessor(AbsPreprocessor):
         if self.label_name in data and self.tokenizer is not None:
             timeseq, text = data[self.label_name]
             # if not isinstance(text, np.ndarray):
-            text = " ".join(text)
-            text = self.text_cleaner(text)
-            tokens = self.tokenizer.text2tokens(text)
-            text_ints = self.token_id_converter.tokens2ids(tokens)
-
-            vowel_tokens = ["a", "e", "i", "o", "u"]
-            vowel_ints = self.token_id_converter.tokens2ids(vowel_tokens)
+            text_ints = self._text2ints(" ".join(text))
 
             data.pop(self.label_name)
             # [Shuai]: length of label - phone_id seq is the same of midi,
             # global_time_aug_factor has already been applied on midi length in dataset.py, step1. Load data from each loaders
             # so the global_time_aug_factor won`t be applied here when init.
-            labelseq = np.zeros((nsamples))
             offset = timeseq[0, 0]
+            starts = ((timeseq[:, 0] - offset) * self.fs).astype(np.int64)
+            ends = ((timeseq[:, 1] - offset) * self.fs).astype(np.int64) + 1
+            ends[ends > nsamples] = nsamples - 1
+            # Each sample takes the label of the last phone starting at or before
+            # it (as sequential slice writes would) if that phone covers it, else 0:
+            # expand (label, covered length), (0, gap length) runs in one np.repeat
+            bounds = np.minimum(np.append(starts, nsamples), nsamples)
+            covered = np.clip(np.minimum(ends, bounds[1:]) - bounds[:-1], 0, None)
+            gaps = np.clip(bounds[1:] - bounds[:-1], 0, None) - covered
+            values = np.stack([text_ints, np.zeros_like(text_ints)], axis=-1)
+            lengths = np.stack([covered, gaps], axis=-1)
+            labelseq = np.concatenate(
+                [
+                    np.zeros(bounds[0]),
+                    np.repeat(values.reshape(-1), lengths.reshape(-1)),
+                ]
+            )
+            # ends clamped to nsamples - 1 leave the last sample to the last phone
+            # ending exactly at nsamples
+            covers_last = np.nonzero((starts < nsamples) & (ends == nsamples))[0]
+            labelseq[-1] = text_ints[covers_last[-1]] if len(covers_last) else 0
+
+            # phone-level augmentation for vowels
             anchor_pairs = []
-            for i in range(timeseq.shape[0]):
-                start = int((timeseq[i, 0] - offset) * self.fs)
-                end = int((timeseq[i, 1] - offset) * self.fs) + 1
-                if end > nsamples:
-                    end = nsamples - 1
-                labelseq[start:end] = text_ints[i]
-
-                # phone-level augmentation for vowels
-                if text_ints[i] in vowel_ints and phone_time_aug_factor != 1.0:
-                    if random.random() < 0.5:
-                        anchor_pairs.append((start, end, text_ints[i]))
+            if phone_time_aug_factor != 1.0:
+                is_anchor = np.isin(text_ints, self.vowel_ints)
+                is_anchor &= np.random.random(len(text_ints)) < 0.5
+                # anchor_pairs: (K, 3) of (start, end, label)
+                anchor_pairs = np.stack([starts, ends, text_ints], axis=-1)[is_anchor]
             # logging.info(f"anchor_pairs: {anchor_pairs}， uid: {uid}, phone_time_aug_factor: {phone_time_aug_factor}")
 
             # phone-level augmentation
             if len(anchor_pairs) != 0:
-                insert_indexes_label = []
-                insert_values_label = []
-                insert_values_score = []
-                insert_values_tempo = []
-                insert_num_list = []
-                for anchor_pair in anchor_pairs:
-                    start, end, _label = anchor_pair
-                    index_gap_origin = end - start
-                    index_gap_aug = (end - start) * phone_time_aug_factor
-                    insert_num = int(index_gap_aug - index_gap_origin)
-                    insert_num_list.append(insert_num)
-
-                    insert_indexes_label += [end for _ in range(insert_num)]
-                    insert_values_label += [_label for _ in range(insert_num)]
-
-                    # logging.info(f"end: {end}, nsamples: {nsamples}")
-                    insert_values_score += [
-                        data["score"][end] for _ in range(insert_num)
-                    ]
-                    insert_values_tempo += [
-                        data["tempo"][end] for _ in range(insert_num)
-                    ]
+                anchor_starts, anchor_ends, anchor_labels = anchor_pairs.T
+                index_gap_origin = anchor_ends - anchor_starts
+                index_gap_aug = index_gap_origin * phone_time_aug_factor
+                insert_num_list = (index_gap_aug - index_gap_origin).astype(np.int64)
+                insert_nums = np.maximum(insert_num_list, 0)
 
+                # insert the label of each anchor insert_num times before its end
                 labelseq = np.insert(
-                    labelseq, insert_indexes_label, insert_values_label
+                    labelseq,
+                    np.repeat(anchor_ends, insert_nums),
+                    np.repeat(anchor_labels, insert_nums),
                 )
 
-                data["score"] = np.insert(
-                    data["score"], insert_indexes_label, insert_values_score
-                )
-                data["tempo"] = np.insert(
-                    data["tempo"], insert_indexes_label, insert_values_tempo
-                )
+                # while score and tempo repeat their value at the end
+                counts = np.ones(len(data["score"]), dtype=np.int64)
+                has_insert = insert_nums > 0
+                np.add.at(counts, anchor_ends[has_insert], insert_nums[has_insert])
+                data["score"] = np.repeat(data["score"], counts)
+                data["tempo"] = np.repeat(data["tempo"], counts)
             labelseq.astype(np.int64)
             data["durations"] = labelseq
 
@@ -314,37 +407,49 @@ class CommonPreprocessor(AbsPreprocessor):
             # logging.info(f"In self.singing_name, len(anchor_pairs): {len(anchor_pairs)}")
 
             # phone-level augmentation
-            insert_accumulative = 0
             if phone_time_aug_factor != 1.0:
                 if len(anchor_pairs) != 0:
                     singing = data[self.singing_name]
                     nsamples = len(singing)
-                    s_ap = [[0], [0]]
-                    for i in range(len(anchor_pairs)):
-                        start, end, _ = anchor_pairs[i]
-                        if start != 0:
-                            s_ap[0].append(start)
-                        s_ap[0].append(end)
-
-                        insert_num = insert_num_list[i]
-                        if start + insert_accumulative != 0:
-                            s_ap[1].append(start + insert_accumulative)
-                        s_ap[1].append(end + insert_accumulative + insert_num)
-                        insert_accumulative += insert_num
-                    if end != nsamples:
-                        s_ap[0].append(nsamples)
-                        s_ap[1].append(nsamples + insert_accumulative)
+                    # anchor points: (start, end) of each anchor in the input
+                    # and shifted by the samples inserted before them in the output
+                    insert_accumulative = np.concatenate(
+                        [[0], np.cumsum(insert_num_list)]
+                    )
+                    starts, ends = anchor_pairs[:, 0], anchor_pairs[:, 1]
+                    src = np.stack([starts, ends], axis=-1)
+                    dst = np.stack(
+                        [
+                            starts + insert_accumulative[:-1],
+                            ends + insert_accumulative[1:],
+                        ],
+                        axis=-1,
+                    )
+                    # skip the points at 0, which is always the first one
+                    src_keep = np.ones(src.shape, dtype=bool)
+                    src_keep[:, 0] = starts != 0
+                    dst_keep = np.ones(dst.shape, dtype=bool)
+                    dst_keep[:, 0] = dst[:, 0] != 0
+                    s_ap = [
+                        np.concatenate([[0], src[src_keep]]),
+                        np.concatenate([[0], dst[dst_keep]]),
+                    ]
+                    if ends[-1] != nsamples:
+                        s_ap[0] = np.append(s_ap[0], nsamples)
+                        s_ap[1] = np.append(s_ap[1], nsamples + insert_accumulative[-1])
 
                     # logging.info(f"s_ap: {s_ap}, ndim of s_ap: {np.array(s_ap).ndim}, phone_time_aug_factor: {phone_time_aug_factor}")
-                    assert np.array(s_ap).ndim == 2
-                    singing = tsm.wsola(singing, np.array(s_ap))
+                    assert len(s_ap[0]) == len(s_ap[1])
+                    singing = tsm.wsola(singing, np.stack(s_ap))
                     # logging.info(f"singing: {singing.shape}, nsamples: {nsamples}, phone_time_aug_factor: {phone_time_aug_factor}")
                     data[self.singing_name] = singing
 
             # quit()
 
             if self.train and self.rirs is not None and self.noises is not None:
-                singing = data[self.singing_name]
+                # float32 is enough for the augmentation
+                # and halves the memory traffic of the convolution
+                singing = data[self.singing_name].astype(np.float32)
                 nsamples = len(singing)
 
                 # singing: (Nmic, Time)
@@ -353,26 +458,26 @@ class CommonPreprocessor(AbsPreprocessor):
                 else:
                     singing = singing.T
                 # Calc power on non shlence region
-                power = (singing[detect_non_silence(singing)] ** 2).mean()
+                detects = detect_non_silence(singing)
+                power = _non_silence_power(singing, detects)
 
                 # 1. Convolve RIR
                 if self.rirs is not None and self.rir_apply_prob >= np.random.random():
                     rir_path = np.random.choice(self.rirs)
                     if rir_path is not None:
-                        rir, _ = soundfile.read(
-                            rir_path, dtype=np.float64, always_2d=True
-                        )
-
                         # rir: (Nmic, Time)
-                        rir = rir.T
+                        rir = _read_rir(rir_path)
 
                         # singing: (Nmic, Time)
                         # Note that this operation doesn't change the signal length
-                        singing = scipy.signal.convolve(singing, rir, mode="full")[
-                            :, : singing.shape[1]
-                        ]
+                        # Overlap-add FFT convolution along time only
+                        singing = scipy.signal.oaconvolve(
+                            singing, rir, mode="full", axes=-1
+                        )[:, : singing.shape[1]]
                         # Reverse mean power to the original power
-                        power2 = (singing[detect_non_silence(singing)] ** 2).mean()
+                        # (the RIR does not move the non-silence region much,
+                        # so the same detection is reused)
+                        power2 = _non_silence_power(singing, detects)
                         singing = np.sqrt(power / max(power2, 1e-10)) * singing
 
                 # 2. Add Noise
@@ -380,33 +485,35 @@ class CommonPreprocessor(AbsPreprocessor):
                     self.noises is not None
                     and self.rir_apply_prob >= np.random.random()
                 ):
-                    noise_path = np.random.choice(self.noises)
+                    noise_idx = np.random.choice(len(self.noises))
+                    noise_path = self.noises[noise_idx]
                     if noise_path is not None:
                         noise_db = np.random.uniform(
                             self.noise_db_low, self.noise_db_high
                         )
-                        with soundfile.SoundFile(noise_path) as f:
-                            if f.frames == nsamples:
-                                noise = f.read(dtype=np.float64, always_2d=True)
-                            elif f.frames < nsamples:
-                                offset = np.random.randint(0, nsamples - f.frames)
-                                # noise: (Time, Nmic)
-                                noise = f.read(dtype=np.float64, always_2d=True)
+                        frames = self.noise_frames[noise_idx]
+                        if frames <= nsamples:
+                            # noise: (Time, Nmic)
+                            noise = _read_noise(noise_path)
+                            if frames < nsamples:
+                                offset = np.random.randint(0, nsamples - frames)
                                 # Repeat noise
                                 noise = np.pad(
                                     noise,
-                                    [(offset, nsamples - f.frames - offset), (0, 0)],
+                                    [(offset, nsamples - frames - offset), (0, 0)],
                                     mode="wrap",
                                 )
-                            else:
-                                offset = np.random.randint(0, f.frames - nsamples)
+                        else:
+                            # decode only the window of a long noise
+                            offset = np.random.randint(0, frames - nsamples)
+                            with soundfile.SoundFile(noise_path) as f:
                                 f.seek(offset)
                                 # noise: (Time, Nmic)
                                 noise = f.read(
-                                    nsamples, dtype=np.float64, always_2d=True
+                                    nsamples, dtype=np.float32, always_2d=True
                                 )
-                                if len(noise) != nsamples:
-                                    raise RuntimeError(f"Something wrong: {noise_path}")
+                            if len(noise) != nsamples:
+                                raise RuntimeError(f"Something wrong: {noise_path}")
                         # noise: (Nmic, Time)
                         noise = noise.T
 
@@ -419,9 +526,11 @@ class CommonPreprocessor(AbsPreprocessor):
                         singing = singing + scale * noise
 
                 singing = singing.T
-                ma = np.max(np.abs(singing))
-                if ma > 1.0:
-                    singing /= ma
+                # the volume normalization below rescales the peak anyway
+                if self.singing_volume_normalize is None:
+                    ma = np.max(np.abs(singing))
+                    if ma > 1.0:
+                        singing /= ma
                 data[self.singing_name] = singing
 
             if self.singing_volume_normalize is not None:
@@ -435,11 +544,7 @@ class CommonPreprocessor(AbsPreprocessor):
             if not isinstance(text, np.ndarray):
                 if not isinstance(text, str):
                     text = " ".join(text)
-                text = self.text_cleaner(text)
-                tokens = self.tokenizer.text2tokens(text)
-                _text_ints = self.token_id_converter.tokens2ids(tokens)
-                # assert text_ints == _text_ints
-                data[self.text_name] = np.array(_text_ints, dtype=np.int64)
+                data[self.text_name] = self._text2ints(text)
         # TODO allow the tuple type
         # assert check_return_type(data)
         # logging.info(f"uid: {uid}, data: {data}")
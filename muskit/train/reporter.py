@@ -53,6 +53,32 @@ def to_reported_value(v: Num, weight: Num = None) -> "ReportedValue":
     return retval
 
 
+def fetch_scalar_tensors(
+    stats: Dict[str, Optional[Union[Num, Dict[str, Num]]]], weight: Num = None
+) -> Tuple[Dict[str, Optional[Union[Num, Dict[str, Num]]]], Num]:
+    """Copy the single element tensors in stats and weight to host at once.
+
+    Calling .item() on each value would synchronize with the device per value,
+    so the values are stacked and transferred with a single copy instead.
+
+    """
+    keys = [
+        k for k, v in stats.items() if isinstance(v, torch.Tensor) and v.numel() == 1
+    ]
+    tensors = [stats[k] for k in keys]
+    if isinstance(weight, torch.Tensor) and weight.numel() == 1:
+        tensors.append(weight)
+    if len(tensors) < 2 or len({v.device for v in tensors}) != 1:
+        return stats, weight
+
+    values = torch.stack([v.detach().reshape(()).float() for v in tensors]).tolist()
+    stats = dict(stats)
+    stats.update(zip(keys, values))
+    if len(values) > len(keys):
+        weight = values[-1]
+    return stats, weight
+
+
 def aggregate(values: Sequence["ReportedValue"]) -> Num:
     assert check_argument_types()
 
@@ -160,6 +186,7 @@ class SubReporter:
         assert check_argument_types()
         if self._finished:
             raise RuntimeError("Already finished")
+        stats, weight = fetch_scalar_tensors(stats, weight)
         if len(self._seen_keys_in_the_step) == 0:
             # Increment count as the first register in this step
             self.total_count += 1
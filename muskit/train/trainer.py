@@ -87,6 +87,7 @@ class TrainerOptions:
     ngpu: int
     resume: bool
     use_amp: bool
+    amp_dtype: str
     train_dtype: str
     grad_noise: bool
     accum_grad: int
@@ -210,7 +211,14 @@ class Trainer:
                 raise RuntimeError(
                     "Require torch>=1.6.0 for  Automatic Mixed Precision"
                 )
-            if trainer_options.sharded_ddp:
+            if trainer_options.amp_dtype == "bfloat16":
+                if LooseVersion(torch.__version__) < LooseVersion("1.10.0"):
+                    raise RuntimeError(
+                        "Require torch>=1.10.0 for bfloat16 Automatic Mixed Precision"
+                    )
+                # bfloat16 has the same exponent range as float32: no loss scaling
+                scaler = None
+            elif trainer_options.sharded_ddp:
                 if fairscale is None:
                     raise RuntimeError(
                         "Requiring fairscale. Do 'pip install fairscale'"
@@ -471,6 +479,9 @@ class Trainer:
         ngpu = options.ngpu
         use_wandb = options.use_wandb
         distributed = distributed_option.distributed
+        autocast_kwargs = {}
+        if options.use_amp and options.amp_dtype != "float16":
+            autocast_kwargs.update(dtype=getattr(torch, options.amp_dtype))
 
         if log_interval is None:
             try:
@@ -500,7 +511,7 @@ class Trainer:
                 all_steps_are_invalid = False
                 continue
 
-            with autocast(scaler is not None):
+            with autocast(options.use_amp, **autocast_kwargs):
                 with reporter.measure_time("forward_time"):
 
                     del_keys = ["pitch_aug", "pitch_aug_lengths", "time_aug", "time_aug_lengths"]